@@ -0,0 +1,128 @@
+import json
+import time
+
+import configargparse
+import numpy as np
+
+from utils import get_logger
+
+from model.dataset.chunking import plan_sentence_windows
+
+
+def get_chunking_benchmark_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Benchmark of sentence chunking of documents.')
+
+    parser.add_argument('--n_sentences', type=int, nargs='+', default=[100, 1000, 5000],
+                        help='Number of sentences in synthetic documents.')
+    parser.add_argument('--max_sentence_len', type=int, default=60, help='Max number of tokens in sentence.')
+    parser.add_argument('--document_len', type=int, default=317, help='Max number of document tokens in chunk.')
+    parser.add_argument('--n_docs', type=int, default=5, help='Number of documents of every size.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
+    parser.add_argument('--output', type=str, default=None, help='Path to JSON report.')
+
+    return parser
+
+
+def legacy_split_by_sentence(t_sens, document_len):
+    # chunking which was used before window planning, it is kept for comparison only
+    doc_start = 0
+    doc_end = 0
+
+    chunk_sents = []
+    samples = []
+
+    for sen_ in t_sens:
+        if doc_end - doc_start + len(sen_) > document_len:
+            while len(chunk_sents) and (doc_end - doc_start + len(sen_) > document_len):
+                samples.append((sum(chunk_sents, []), len(chunk_sents), doc_start, doc_end))
+
+                del_sen = chunk_sents.pop(0)
+                doc_start += len(del_sen)
+
+        doc_end += len(sen_)
+
+        chunk_sents.append(sen_)
+
+    samples.append((sum(chunk_sents, []), len(chunk_sents), doc_start, doc_end))
+
+    return samples
+
+
+def split_by_sentence(input_ids, sentence_bounds, document_len):
+    doc_starts, doc_ends, n_sents = plan_sentence_windows(sentence_bounds, document_len)
+
+    # document is converted to list once, so chunks are copied by list slicing
+    input_ids = input_ids.tolist()
+
+    return [(input_ids[ds:de], cl, ds, de)
+            for ds, de, cl in zip(doc_starts.tolist(), doc_ends.tolist(), n_sents.tolist())]
+
+
+def generate_document(n_sentences, max_sentence_len):
+    sentence_lens = np.random.randint(0, max_sentence_len + 1, size=n_sentences)
+    sentence_bounds = np.zeros(n_sentences + 1, dtype=np.int64)
+    np.cumsum(sentence_lens, out=sentence_bounds[1:])
+
+    input_ids = np.random.randint(0, 30000, size=sentence_bounds[-1]).astype(np.int32)
+
+    return input_ids, sentence_bounds
+
+
+def main(params):
+    np.random.seed(params.seed)
+
+    report = {}
+    for n_sentences in params.n_sentences:
+        documents = [generate_document(n_sentences, params.max_sentence_len) for _ in range(params.n_docs)]
+
+        for input_ids, bounds in documents:
+            t_sens = [input_ids[start:end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
+            assert split_by_sentence(input_ids, bounds, params.document_len) == \
+                legacy_split_by_sentence(t_sens, params.document_len), 'Chunks are not equal to legacy ones.'
+
+        # legacy chunking materializes all chunks of document
+        start = time.perf_counter()
+        for input_ids, bounds in documents:
+            t_sens = [input_ids[start:end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
+            legacy_split_by_sentence(t_sens, params.document_len)
+        legacy_time = (time.perf_counter() - start) / len(documents)
+
+        # training dataset samples one chunk of document
+        start = time.perf_counter()
+        for input_ids, bounds in documents:
+            doc_starts, doc_ends, _ = plan_sentence_windows(bounds, params.document_len)
+            idx = np.random.randint(len(doc_starts))
+            input_ids[doc_starts[idx]:doc_ends[idx]].tolist()
+        sample_time = (time.perf_counter() - start) / len(documents)
+
+        # validation dataset materializes all chunks of document
+        start = time.perf_counter()
+        n_chunks = [len(split_by_sentence(input_ids, bounds, params.document_len)) for input_ids, bounds in documents]
+        all_time = (time.perf_counter() - start) / len(documents)
+
+        report[n_sentences] = {'n_chunks': float(np.mean(n_chunks)),
+                               'legacy_ms': 1e3 * legacy_time,
+                               'sample_ms': 1e3 * sample_time,
+                               'all_ms': 1e3 * all_time,
+                               'sample_speedup': legacy_time / sample_time,
+                               'all_speedup': legacy_time / all_time}
+
+        result = report[n_sentences]
+        logger.info(f'{n_sentences:>6} sentences, {result["n_chunks"]:.0f} chunks: '
+                    f'legacy {result["legacy_ms"]:.2f} ms/doc, '
+                    f'one chunk {result["sample_ms"]:.2f} ms/doc ({result["sample_speedup"]:.1f}x faster), '
+                    f'all chunks {result["all_ms"]:.2f} ms/doc ({result["all_speedup"]:.1f}x faster).')
+
+    if params.output is not None:
+        with open(params.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+        logger.info(f'Report was dumped to {params.output}.')
+
+    return report
+
+
+if __name__ == '__main__':
+    params = get_chunking_benchmark_parser().parse_args()
+    logger = get_logger(logger_name='benchmark')
+
+    main(params)
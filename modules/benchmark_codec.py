@@ -0,0 +1,89 @@
+import itertools
+import json
+import time
+
+import configargparse
+
+from utils import get_logger
+
+from model.dataset.codec import JsonCodec, available_codecs, get_codec
+from model.dataset.split_dataset import LineDataExtractor, RawPreprocessor, StreamDataExtractor
+
+
+def get_codec_benchmark_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Benchmark of processed document codecs.')
+
+    parser.add_argument('--data_path', type=str, required=True, help='Path to JSON with raw documents.')
+    parser.add_argument('--n_docs', type=int, default=1000, help='Number of benchmarked documents.')
+    parser.add_argument('--n_repeats', type=int, default=5, help='Number of decoding passes over documents.')
+    parser.add_argument('--output', type=str, default=None, help='Path to JSON report.')
+
+    return parser
+
+
+def legacy_process_line(raw_line):
+    # record schema which was used before projection, it is kept for comparison only
+    line = RawPreprocessor._process_line(raw_line)
+
+    annotations = raw_line['annotations'][0]
+    start, end = line['long_answer_start'], line['long_answer_end']
+
+    line['long_answer'] = 'NONE' if start == end else raw_line['document_text'].split()[start:end]
+    line['short_answers'] = annotations['short_answers']
+    line['long_answer_candidates'] = raw_line['long_answer_candidates']
+
+    return line
+
+
+def benchmark_codec(codec, records, n_repeats):
+    start = time.perf_counter()
+    encoded = [codec.encode(record) for record in records]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        for data in encoded:
+            codec.decode(data)
+    decode_time = (time.perf_counter() - start) / n_repeats
+
+    return {'size_mb': sum(len(data) for data in encoded) / 2 ** 20,
+            'encode_us': 1e6 * encode_time / len(records),
+            'decode_us': 1e6 * decode_time / len(records)}
+
+
+def main(params):
+    data_extractor = StreamDataExtractor(params.data_path) if StreamDataExtractor.is_stream(params.data_path) \
+        else LineDataExtractor(params.data_path)
+
+    raw_lines = list(itertools.islice(iter(data_extractor), params.n_docs))
+    logger.info(f'{len(raw_lines)} documents were loaded from {params.data_path}.')
+
+    legacy_records = [legacy_process_line(raw_line) for raw_line in raw_lines]
+    records = [RawPreprocessor._process_line(raw_line) for raw_line in raw_lines]
+
+    report = {'legacy-json': benchmark_codec(JsonCodec, legacy_records, params.n_repeats)}
+    for name in available_codecs():
+        report[name] = benchmark_codec(get_codec(name), records, params.n_repeats)
+
+    baseline = report['legacy-json']
+    for name, result in report.items():
+        result['size_ratio'] = result['size_mb'] / baseline['size_mb']
+        result['decode_speedup'] = baseline['decode_us'] / result['decode_us']
+
+        logger.info(f'{name:>12}: size {result["size_mb"]:.2f} MB ({result["size_ratio"]:.2f}x), '
+                    f'encode {result["encode_us"]:.1f} us/doc, decode {result["decode_us"]:.1f} us/doc '
+                    f'({result["decode_speedup"]:.2f}x faster).')
+
+    if params.output is not None:
+        with open(params.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+        logger.info(f'Report was dumped to {params.output}.')
+
+    return report
+
+
+if __name__ == '__main__':
+    params = get_codec_benchmark_parser().parse_args()
+    logger = get_logger(logger_name='benchmark')
+
+    main(params)
@@ -0,0 +1,133 @@
+import json
+import time
+
+import configargparse
+import numpy as np
+import torch
+
+from utils import get_logger
+
+from model.dataset import DummyDataset, collate_fun
+from model.model import Tokenizer
+
+
+def get_collate_benchmark_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Benchmark of batch collation.')
+
+    parser.add_argument('--model_name', type=str, default='bert', choices=['bert', 'roberta'],
+                        help='Tokenizer model name.')
+    parser.add_argument('--vocab_file', type=str, required=True, help='Path to WoldPiece/BPE vocab.')
+    parser.add_argument('--merges_file', type=str, default=None, help='BPE merge table path.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 32, 64, 128, 256, 512],
+                        help='Benchmarked batch sizes.')
+    parser.add_argument('--max_seq_len', type=int, default=384, help='Max input seq length.')
+    parser.add_argument('--max_question_len', type=int, default=64, help='Max question length.')
+    parser.add_argument('--min_seq_len', type=int, default=96, help='Min length of dummy items.')
+    parser.add_argument('--n_repeats', type=int, default=20, help='Number of collated batches of every size.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
+    parser.add_argument('--output', type=str, default=None, help='Path to JSON report.')
+
+    return parser
+
+
+def legacy_collate_fun(items, tokenizer, return_items=False):
+    # collation which was used before vectorization, it is kept for comparison only
+    batch_size = len(items)
+    pad_token_id = tokenizer.pad_token_id
+
+    max_len = max([len(item.input_ids) for item in items])
+    tokens = pad_token_id * np.ones((batch_size, max_len), dtype=np.int64)
+
+    type_coef = 1 if tokenizer.model_name == 'bert' else 0
+    token_type_ids = type_coef * np.ones((batch_size, max_len), dtype=np.int64)
+
+    for i, item in enumerate(items):
+        row = item.input_ids
+
+        tokens[i, :len(row)] = row
+        if type_coef:
+            token_type_ids[i, :len(row)] = [0 if i <= row.index(tokenizer.sep_token_id) else 1 for i in range(len(row))]
+
+    attention_mask = tokens > 0
+    inputs = {'input_ids': torch.from_numpy(tokens),
+              'attention_mask': torch.from_numpy(attention_mask),
+              'token_type_ids': torch.from_numpy(token_type_ids)}
+
+    # output labels
+    start_ids = np.array([item.start_id for item in items])
+    end_ids = np.array([item.end_id for item in items])
+
+    start_pos = np.array([item.start_position for item in items])
+    end_pos = np.array([item.end_position for item in items])
+
+    label_ids = [item.label_id for item in items]
+
+    labels = {'start_class': torch.LongTensor(start_ids),
+              'end_class': torch.LongTensor(end_ids),
+              'start_reg': torch.FloatTensor(start_pos),
+              'end_reg': torch.FloatTensor(end_pos),
+              'cls': torch.LongTensor(label_ids)}
+
+    if return_items:
+        return [inputs, labels, items]
+
+    return [inputs, labels]
+
+
+def benchmark_collation(collate, batches):
+    start = time.perf_counter()
+    for batch in batches:
+        collate(batch)
+
+    return 1e3 * (time.perf_counter() - start) / len(batches)
+
+
+def main(params):
+    np.random.seed(params.seed)
+
+    tokenizer = Tokenizer(params.model_name, params.vocab_file, merges_file=params.merges_file)
+    dataset = DummyDataset(tokenizer,
+                           max_seq_len=params.max_seq_len,
+                           max_question_len=params.max_question_len,
+                           min_seq_len=params.min_seq_len,
+                           dataset_len=max(params.batch_sizes) * params.n_repeats)
+    items = [dataset[i] for i in range(len(dataset))]
+
+    collate_funs = {'legacy': lambda batch: legacy_collate_fun(batch, tokenizer),
+                    'vectorized': lambda batch: collate_fun(batch, tokenizer),
+                    'vectorized-pad8': lambda batch: collate_fun(batch, tokenizer, pad_multiple=8)}
+    if torch.cuda.is_available():
+        collate_funs['vectorized-pinned'] = lambda batch: collate_fun(batch, tokenizer, pin_memory=True)
+
+    batch = items[:max(params.batch_sizes)]
+    legacy_inputs, legacy_labels = legacy_collate_fun(batch, tokenizer)
+    inputs, labels = collate_fun(batch, tokenizer)
+    assert all(torch.equal(legacy_inputs[k], inputs[k]) for k in legacy_inputs) and \
+        all(torch.equal(legacy_labels[k], labels[k]) for k in legacy_labels), 'Batch is not equal to legacy one.'
+    logger.info('Vectorized batch is identical to legacy one.')
+
+    report = {}
+    for batch_size in params.batch_sizes:
+        batches = [items[i:i + batch_size] for i in range(0, batch_size * params.n_repeats, batch_size)]
+
+        report[batch_size] = {name: {'ms_per_batch': benchmark_collation(collate, batches)}
+                              for name, collate in collate_funs.items()}
+
+        for name, result in report[batch_size].items():
+            result['speedup'] = report[batch_size]['legacy']['ms_per_batch'] / result['ms_per_batch']
+            logger.info(f'Batch size {batch_size:>4}, {name:>17}: {result["ms_per_batch"]:.2f} ms/batch '
+                        f'({result["speedup"]:.1f}x faster).')
+
+    if params.output is not None:
+        with open(params.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+        logger.info(f'Report was dumped to {params.output}.')
+
+    return report
+
+
+if __name__ == '__main__':
+    params = get_collate_benchmark_parser().parse_args()
+    logger = get_logger(logger_name='benchmark')
+
+    main(params)
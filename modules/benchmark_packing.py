@@ -0,0 +1,119 @@
+import json
+import time
+
+import configargparse
+import torch
+import torch.nn as nn
+
+from init import init_collate_fun, init_model
+from utils import get_logger, set_seed
+
+from model.dataset import DummyDataset
+from model.model import WeightedLoss
+from model.utils.parser import get_model_parser, get_params
+
+
+def get_packing_benchmark_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Benchmark of sequence packing on dummy dataset.')
+
+    parser.add_argument('--max_seq_len', type=int, default=384, help='Max input seq length.')
+    parser.add_argument('--max_question_len', type=int, default=64, help='Max question length.')
+    parser.add_argument('--min_seq_len', type=int, default=96, help='Min length of dummy items.')
+    parser.add_argument('--batch_size', type=int, default=32, help='Number of items in batch.')
+    parser.add_argument('--n_batches', type=int, default=20, help='Number of measured batches.')
+    parser.add_argument('--n_warmup_batches', type=int, default=2, help='Number of not measured batches.')
+    parser.add_argument('--gpu', action='store_true', help='Use gpu.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
+    parser.add_argument('--output', type=str, default=None, help='Path to JSON report.')
+
+    return parser
+
+
+def benchmark_training(model, loss, batches, device, n_warmup_batches):
+    n_tokens, n_rows = 0, 0
+    start = None
+
+    for batch_i, (inputs, labels) in enumerate(batches):
+        if batch_i == n_warmup_batches:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        labels = {k: v.to(device) for k, v in labels.items()}
+
+        model.zero_grad()
+        loss(model(**inputs), labels).backward()
+
+        if batch_i >= n_warmup_batches:
+            n_tokens += int(torch.sum(inputs['attention_mask'].any(dim=-1))) if inputs['attention_mask'].dim() == 3 \
+                else int(torch.sum(inputs['attention_mask']))
+            n_rows += inputs['input_ids'].size(0)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed_time = time.perf_counter() - start
+
+    return {'tokens_per_sec': n_tokens / elapsed_time,
+            'rows_per_batch': n_rows / (len(batches) - n_warmup_batches)}
+
+
+def main(params, model_params):
+    set_seed(params.seed)
+
+    device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
+
+    model, tokenizer = init_model(model_params, device=device)
+    loss = WeightedLoss({'start_class': (nn.CrossEntropyLoss(ignore_index=-1), 1),
+                         'end_class': (nn.CrossEntropyLoss(ignore_index=-1), 1),
+                         'cls': (nn.CrossEntropyLoss(), 1)}).to(device)
+
+    n_batches = params.n_warmup_batches + params.n_batches
+    dataset = DummyDataset(tokenizer,
+                           max_seq_len=params.max_seq_len,
+                           max_question_len=params.max_question_len,
+                           min_seq_len=params.min_seq_len,
+                           dataset_len=n_batches * params.batch_size)
+    items = [dataset[i] for i in range(len(dataset))]
+    item_batches = [items[i:i + params.batch_size] for i in range(0, len(items), params.batch_size)]
+
+    collate_funs = {'padded': init_collate_fun(tokenizer),
+                    'packed': init_collate_fun(tokenizer, pack_sequences=True, max_seq_len=params.max_seq_len)}
+    batches = {name: [collate_fun(batch) for batch in item_batches] for name, collate_fun in collate_funs.items()}
+
+    # outputs of packed batch are equal to outputs of padded batch without dropout
+    model.eval()
+    with torch.no_grad():
+        outputs = {name: model(**{k: v.to(device) for k, v in name_batches[0][0].items()})
+                   for name, name_batches in batches.items()}
+    lengths = batches['packed'][0][0]['segments'][:, 2].to(device)
+    segment_mask = torch.arange(int(lengths.max()), device=device).unsqueeze(0) < lengths.unsqueeze(-1)
+    for key in ('start_class', 'end_class', 'cls'):
+        padded, packed = outputs['padded'][key], outputs['packed'][key]
+        if key != 'cls':
+            padded, packed = padded[segment_mask], packed[segment_mask]
+        assert torch.allclose(padded, packed, atol=1e-3), f'Packed outputs {key} are not equal to padded ones.'
+    logger.info('Outputs of packed batches are equal to outputs of padded batches.')
+
+    model.train()
+    report = {name: benchmark_training(model, loss, name_batches, device, params.n_warmup_batches)
+              for name, name_batches in batches.items()}
+
+    for name, result in report.items():
+        result['speedup'] = result['tokens_per_sec'] / report['padded']['tokens_per_sec']
+        logger.info(f'{name:>8}: {result["rows_per_batch"]:.1f} rows per batch of {params.batch_size} items, '
+                    f'{result["tokens_per_sec"]:.0f} tokens/sec ({result["speedup"]:.2f}x faster).')
+
+    if params.output is not None:
+        with open(params.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+        logger.info(f'Report was dumped to {params.output}.')
+
+    return report
+
+
+if __name__ == '__main__':
+    _, (params, model_params) = get_params((get_packing_benchmark_parser, get_model_parser))
+    logger = get_logger(logger_name='benchmark')
+
+    main(params, model_params)
@@ -0,0 +1,140 @@
+import json
+import re
+import time
+
+import configargparse
+import numpy as np
+
+from utils import get_logger
+
+from model.dataset.encoding import encode_document, load_sentence_tokenizer
+from model.dataset.split_dataset import LineDataExtractor, StreamDataExtractor
+from model.model import Tokenizer
+
+
+def get_tokenization_benchmark_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Benchmark of document tokenization.')
+
+    parser.add_argument('--data_path', type=str, required=True, help='Path to JSON with raw documents.')
+    parser.add_argument('--model_name', type=str, default='bert', choices=['bert', 'roberta'],
+                        help='Tokenizer model name.')
+    parser.add_argument('--vocab_file', type=str, required=True, help='Path to WoldPiece/BPE vocab.')
+    parser.add_argument('--merges_file', type=str, default=None, help='BPE merge table path.')
+    parser.add_argument('--lowercase', action='store_true', help='Tokenize lowercase strings.')
+    parser.add_argument('--split_by_sentence', action='store_true', help='Split documents by sentence.')
+    parser.add_argument('--n_docs', type=int, default=100, help='Number of benchmarked documents.')
+    parser.add_argument('--min_words', type=int, default=5000, help='Min number of words in benchmarked documents.')
+    parser.add_argument('--n_repeats', type=int, default=3, help='Number of passes over documents.')
+    parser.add_argument('--output', type=str, default=None, help='Path to JSON report.')
+
+    return parser
+
+
+def legacy_drop_tags_and_encode(tokenizer, text, *, history_len=0, start=-1):
+    # word by word encoding which was used before batch encoding, it is kept for comparison only
+    text = text.split()
+
+    o2t = []
+    t2o = []
+
+    tokenized_text = []
+    word_i = 0
+    for word_i, word in enumerate(text, start=start + 1):
+        o2t.append(len(tokenized_text) + history_len)
+        if re.match(r'<.+>', word):
+            continue
+
+        word_tokens = tokenizer.encode(word)
+        for token in word_tokens:
+            t2o.append(word_i)
+            tokenized_text.append(token)
+
+    return tokenized_text, o2t, t2o, history_len + len(tokenized_text), word_i
+
+
+def legacy_encode_document(tokenizer, text, *, sentence_tokenizer=None):
+    if sentence_tokenizer is None:
+        return legacy_drop_tags_and_encode(tokenizer, text)[:3]
+
+    input_ids, o2t, t2o = [], [], []
+
+    start = -1
+    history = 0
+    for sen in sentence_tokenizer.tokenize(text):
+        sen_ids, sen_o2t, sen_t2o, history, start = legacy_drop_tags_and_encode(tokenizer, sen,
+                                                                                history_len=history,
+                                                                                start=start)
+        input_ids.extend(sen_ids)
+        o2t.extend(sen_o2t)
+        t2o.extend(sen_t2o)
+
+    return input_ids, o2t, t2o
+
+
+def benchmark_encoding(encode_fun, texts, n_repeats):
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        for text in texts:
+            encode_fun(text)
+
+    return 1e3 * (time.perf_counter() - start) / (n_repeats * len(texts))
+
+
+def main(params):
+    data_extractor = StreamDataExtractor(params.data_path) if StreamDataExtractor.is_stream(params.data_path) \
+        else LineDataExtractor(params.data_path)
+
+    texts = []
+    for raw_line in data_extractor:
+        if len(raw_line['document_text'].split()) >= params.min_words:
+            texts.append(raw_line['document_text'])
+        if len(texts) >= params.n_docs:
+            break
+
+    if not texts:
+        raise ValueError(f'There are no documents with {params.min_words} words in {params.data_path}.')
+
+    n_words = np.mean([len(text.split()) for text in texts])
+    logger.info(f'{len(texts)} documents with {n_words:.0f} words on average were loaded from {params.data_path}.')
+
+    tokenizer = Tokenizer(params.model_name, params.vocab_file,
+                          merges_file=params.merges_file,
+                          lowercase=params.lowercase)
+    sentence_tokenizer = load_sentence_tokenizer() if params.split_by_sentence else None
+
+    for text in texts:
+        document = encode_document(tokenizer, text, sentence_tokenizer=sentence_tokenizer)
+        legacy_document = legacy_encode_document(tokenizer, text, sentence_tokenizer=sentence_tokenizer)
+
+        assert all(np.array_equal(array, legacy_array) for array, legacy_array in
+                   zip((document.input_ids, document.o2t, document.t2o), legacy_document))
+
+    logger.info('Batch encoding output is identical to word by word encoding.')
+
+    report = {
+        'legacy': benchmark_encoding(lambda text: legacy_encode_document(tokenizer, text,
+                                                                         sentence_tokenizer=sentence_tokenizer),
+                                     texts, params.n_repeats),
+        'batch': benchmark_encoding(lambda text: encode_document(tokenizer, text,
+                                                                 sentence_tokenizer=sentence_tokenizer),
+                                    texts, params.n_repeats)
+    }
+    report = {name: {'ms_per_doc': ms_per_doc, 'speedup': report['legacy'] / ms_per_doc}
+              for name, ms_per_doc in report.items()}
+
+    for name, result in report.items():
+        logger.info(f'{name:>8}: {result["ms_per_doc"]:.2f} ms/doc ({result["speedup"]:.2f}x faster).')
+
+    if params.output is not None:
+        with open(params.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+        logger.info(f'Report was dumped to {params.output}.')
+
+    return report
+
+
+if __name__ == '__main__':
+    params = get_tokenization_benchmark_parser().parse_args()
+    logger = get_logger(logger_name='benchmark')
+
+    main(params)
@@ -0,0 +1,152 @@
+import itertools
+import json
+import time
+
+import configargparse
+import numpy as np
+import torch
+
+from init import init_loss, init_model, init_optimizer
+from utils import get_logger, set_seed
+
+from model.dataset import DummyDataset
+from model.utils.parser import get_model_parser, get_params
+
+
+def get_training_benchmark_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Benchmark of training steps on synthetic batches.')
+
+    parser.add_argument('--max_seq_lens', type=int, nargs='+', default=[128, 256, 384],
+                        help='Benchmarked max input seq lengths.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32],
+                        help='Benchmarked numbers of items in batch.')
+    parser.add_argument('--batch_splits', type=int, nargs='+', default=[1],
+                        help='Benchmarked numbers of chunks which batch is split into.')
+    parser.add_argument('--max_question_len', type=int, default=64, help='Max question length.')
+    parser.add_argument('--min_seq_len', type=int, default=None,
+                        help='Items have uniformly distributed lengths from [min_seq_len, max_seq_len]. '
+                             'All items have max_seq_len tokens if it is not set.')
+    parser.add_argument('--n_steps', type=int, default=10, help='Number of measured optimizer steps.')
+    parser.add_argument('--n_warmup_steps', type=int, default=2, help='Number of not measured optimizer steps.')
+
+    parser.add_argument('--optimizer', type=str, default='adam', choices=['adam', 'adamod'], help='Optimizer name.')
+    parser.add_argument('--lr', type=float, default=1e-5, help='Learning rate for optimizer.')
+    parser.add_argument('--weight_decay', type=float, default=0.01, help='Weight decay for optimizer.')
+    parser.add_argument('--max_grad_norm', type=float, default=1, help='Max norm of the gradients')
+    parser.add_argument('--loss', type=str, default='ce', choices=['ce'], help='Type of doc label classification loss')
+
+    parser.add_argument('--gpu', action='store_true', help='Use gpu.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
+    parser.add_argument('--output', type=str, default=None, help='Path to JSON report.')
+
+    return parser
+
+
+class StepTimer(object):
+    def __init__(self, device):
+        self.device = device
+        self.times = {'forward': 0.0, 'backward': 0.0, 'optimizer': 0.0}
+
+    def _now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def measure(self, name, fun):
+        start = self._now()
+        result = fun()
+        self.times[name] += self._now() - start
+
+        return result
+
+
+def benchmark_config(model, loss, optimizer, dataset, device, *, batch_size, batch_split, n_steps, n_warmup_steps,
+                     max_grad_norm):
+    chunk_size = batch_size // batch_split
+    assert chunk_size > 0, f'Batch size {batch_size} is less than batch split {batch_split}.'
+
+    # batches are generated before measurement, so data generation is not included in timings
+    n_chunks = (n_warmup_steps + n_steps) * batch_split
+    idxs = np.random.randint(0, len(dataset), (n_chunks, chunk_size))
+    chunks = [[{k: v.to(device) for k, v in data.items()} for data in dataset.get_batch(chunk_idxs)]
+              for chunk_idxs in idxs]
+
+    def optimizer_step():
+        torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
+        optimizer.step()
+        optimizer.zero_grad()
+
+    model.train()
+    optimizer.zero_grad()
+
+    timer = StepTimer(device)
+    n_samples, n_tokens = 0, 0
+
+    for chunk_i, (inputs, labels) in enumerate(chunks):
+        # timings are reset after warmup steps
+        if chunk_i == n_warmup_steps * batch_split:
+            timer = StepTimer(device)
+            n_samples, n_tokens = 0, 0
+
+        pred_logits = timer.measure('forward', lambda: model(**inputs))
+        timer.measure('backward', lambda: (loss(pred_logits, labels) / batch_split).backward())
+        if (chunk_i + 1) % batch_split == 0:
+            timer.measure('optimizer', optimizer_step)
+
+        n_samples += inputs['input_ids'].size(0)
+        n_tokens += int(torch.sum(inputs['attention_mask']))
+
+    total_time = sum(timer.times.values())
+    result = {f'{name}_sec_per_step': value / n_steps for name, value in timer.times.items()}
+    result.update({'samples_per_sec': n_samples / total_time,
+                   'tokens_per_sec': n_tokens / total_time})
+
+    return result
+
+
+def main(params, model_params):
+    set_seed(params.seed)
+
+    device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
+
+    model, tokenizer = init_model(model_params, device=device)
+    loss = init_loss(params, {'label_weights': None}).to(device)
+    optimizer = init_optimizer(params, model)
+
+    report = []
+    for max_seq_len, batch_size, batch_split in itertools.product(params.max_seq_lens, params.batch_sizes,
+                                                                  params.batch_splits):
+        dataset = DummyDataset(tokenizer,
+                               max_seq_len=max_seq_len,
+                               max_question_len=params.max_question_len,
+                               min_seq_len=params.min_seq_len,
+                               dataset_len=max(batch_size, 1024))
+
+        result = benchmark_config(model, loss, optimizer, dataset, device,
+                                  batch_size=batch_size,
+                                  batch_split=batch_split,
+                                  n_steps=params.n_steps,
+                                  n_warmup_steps=params.n_warmup_steps,
+                                  max_grad_norm=params.max_grad_norm)
+        result.update({'max_seq_len': max_seq_len, 'batch_size': batch_size, 'batch_split': batch_split})
+        report.append(result)
+
+        logger.info(f'max_seq_len {max_seq_len}, batch_size {batch_size}, batch_split {batch_split}: '
+                    f'{result["samples_per_sec"]:.1f} samples/sec, {result["tokens_per_sec"]:.0f} tokens/sec, '
+                    f'forward {result["forward_sec_per_step"]:.3f} sec, '
+                    f'backward {result["backward_sec_per_step"]:.3f} sec, '
+                    f'optimizer {result["optimizer_sec_per_step"]:.3f} sec per step.')
+
+    if params.output is not None:
+        with open(params.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+        logger.info(f'Report was dumped to {params.output}.')
+
+    return report
+
+
+if __name__ == '__main__':
+    _, (params, model_params) = get_params((get_training_benchmark_parser, get_model_parser))
+    logger = get_logger(logger_name='benchmark')
+
+    main(params, model_params)
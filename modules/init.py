@@ -9,7 +9,8 @@ import torch.nn as nn
 from transformers import BertTokenizer, RobertaTokenizer, AdamW
 
 from model.model import BertForQuestionAnswering, Tokenizer, LabelSmoothingLossWithLogits, FocalLossWithLogits, WeightedLoss
-from model.dataset import collate_fun, RawPreprocessor, SplitDataset, DummyDataset
+from model.dataset import (collate_fun, packed_collate_fun, RawPreprocessor, SplitDataset, DummyDataset, ShardedStorage,
+                           TokenizedCache, ChunkIndex, StreamingDataset)
 from model.trainer.optim import AdaMod
 
 logger = logging.getLogger(__name__)
@@ -48,7 +49,8 @@ def _load_checkpoint(model, checkpoint, *, device=torch.device('cpu')):
         logger.info(f'Model checkpoint was restored from {checkpoint}.')
 
 
-def init_model(model_params, *, checkpoint=None, device=torch.device('cpu'), bpe_dropout=None):
+def init_model(model_params, *, checkpoint=None, device=torch.device('cpu'), bpe_dropout=None,
+               tokenizer_cache_size=0):
     model_params.model_name = model_params.model.split('-')[0]
 
     # todo: https://github.com/huggingface/transformers/issues/2392
@@ -60,7 +62,8 @@ def init_model(model_params, *, checkpoint=None, device=torch.device('cpu'), bpe
                               merges_file=model_params.merges_file,
                               lowercase=model_params.lowercase,
                               handle_chinese_chars=model_params.handle_chinese_chars,
-                              dropout=bpe_dropout)
+                              dropout=bpe_dropout,
+                              cache_size=tokenizer_cache_size)
     else:
         logger.warning('Specify vocab file to use faster tokenizer implementation.')
         if model_params.model_name == 'bert':
@@ -83,7 +86,7 @@ def init_model(model_params, *, checkpoint=None, device=torch.device('cpu'), bpe
 
 
 def _get_optimized_parameters(params, model):
-    if params.finetune:
+    if getattr(params, 'finetune', False):
         # to froze batchnorms and dropouts
         if params.apex_level is not None:
             params.apex_level = None
@@ -145,9 +148,72 @@ def init_optimizer(params, model):
     return optimizer
 
 
+def init_tokenized_cache(params, tokenizer, *, split_by_sentence=None):
+    if not getattr(params, 'cache_tokens', False):
+        return None
+
+    if getattr(params, 'bpe_dropout', None) is not None:
+        logger.warning('BPE dropout is not applied to documents which are read from tokenized cache.')
+
+    return TokenizedCache.load_or_build(params.processed_data_path,
+                                        ShardedStorage(params.processed_data_path),
+                                        tokenizer,
+                                        split_by_sentence=params.split_by_sentence if split_by_sentence is None
+                                        else split_by_sentence,
+                                        n_jobs=params.preprocess_n_jobs)
+
+
+def init_chunk_index(params, tokenizer, cache):
+    if not getattr(params, 'chunk_index', False):
+        return None
+
+    if cache is None:
+        raise AttributeError('Chunk index requires tokenized cache, set --cache_tokens.')
+
+    return ChunkIndex.load_or_build(ShardedStorage(params.processed_data_path),
+                                    cache,
+                                    tokenizer,
+                                    max_seq_len=params.max_seq_len,
+                                    max_question_len=params.max_question_len,
+                                    doc_stride=params.doc_stride,
+                                    n_jobs=params.preprocess_n_jobs)
+
+
+def init_tokenizer_cache(params, tokenizer):
+    if not getattr(tokenizer, 'cache_size', 0):
+        return
+
+    word_counts = RawPreprocessor.load_word_counts(params.processed_data_path)
+    if not word_counts:
+        logger.warning(f'Words were not counted when {params.processed_data_path} was processed, so tokenizer cache '
+                       f'is not prewarmed. Process data again with --clear_processed to count them.')
+
+    tokenizer.prewarm_cache([word for word, _ in word_counts])
+
+
+def init_streaming_dataset(params, dataset):
+    if params.dummy_dataset or getattr(params, 'chunk_index', False):
+        raise AttributeError('Streaming dataset reads documents of processed data, '
+                             'it is not used with dummy dataset or chunk index.')
+
+    if getattr(params, 'train_sampler_weights', False):
+        logger.warning('Oversampling is not applied to streaming dataset.')
+
+    # samples are split between processes as in distributed samplers
+    replicas = {'num_replicas': 1, 'rank': 0} if getattr(params, 'local_rank', -1) == -1 else {}
+
+    return StreamingDataset(dataset,
+                            block_size=params.stream_block_size,
+                            buffer_size=params.shuffle_buffer_size,
+                            seed=getattr(params, 'seed', None) or 0,
+                            **replicas)
+
+
 def init_datasets(params, *, tokenizer=None, clear=False):
     # dummy_dataset
     weights = defaultdict(lambda: None)
+    cache = None
+    chunk_index = None
 
     if params.dummy_dataset:
         train_indexes = None
@@ -161,10 +227,18 @@ def init_datasets(params, *, tokenizer=None, clear=False):
         dataset_class = SplitDataset
         preprocessor = RawPreprocessor(raw_json=params.data_path,
                                        out_dir=params.processed_data_path,
-                                       clear=clear)
+                                       clear=clear,
+                                       n_jobs=params.preprocess_n_jobs,
+                                       codec=params.storage_codec,
+                                       split_strategy=params.split_strategy,
+                                       count_words=params.tokenizer_cache_size > 0)
 
         labels_counter, labels, (train_indexes, train_labels, test_indexes, test_labels) = preprocessor()
 
+        init_tokenizer_cache(params, tokenizer)
+        cache = init_tokenized_cache(params, tokenizer)
+        chunk_index = init_chunk_index(params, tokenizer, cache)
+
         if getattr(params, 'train_label_weights', False):
             label_weights = np.asarray([1 / labels_counter[k] for k in sorted(labels_counter.keys())])
             label_weights = label_weights / np.sum(label_weights)
@@ -186,7 +260,20 @@ def init_datasets(params, *, tokenizer=None, clear=False):
                                   max_question_len=params.max_question_len,
                                   doc_stride=params.doc_stride,
                                   split_by_sentence=params.split_by_sentence,
-                                  truncate=params.truncate)
+                                  truncate=params.truncate,
+                                  cache=cache,
+                                  chunk_index=chunk_index,
+                                  shared_arrays_dir=getattr(params, 'shared_arrays_dir', None))
+
+    if getattr(params, 'streaming', False):
+        train_dataset = init_streaming_dataset(params, train_dataset)
+        weights['sampler_weights'] = None
+
+    elif chunk_index is not None:
+        # chunks are sampled directly, epoch contains one chunk per train document as before
+        weights['sampler_weights'] = train_dataset.get_sampler_weights(weights['sampler_weights'])
+        weights['sampler_num_samples'] = len(train_indexes)
+
     test_dataset = dataset_class(data_dir=params.processed_data_path,
                                  tokenizer=tokenizer,
                                  indexes=test_indexes,
@@ -195,11 +282,21 @@ def init_datasets(params, *, tokenizer=None, clear=False):
                                  max_question_len=params.max_question_len,
                                  doc_stride=params.doc_stride,
                                  split_by_sentence=params.split_by_sentence,
-                                 truncate=params.truncate) \
+                                 truncate=params.truncate,
+                                 cache=cache,
+                                 shared_arrays_dir=getattr(params, 'shared_arrays_dir', None)) \
         if getattr(params, 'local_rank', -1) in [-1, 0] else None
 
     return train_dataset, test_dataset, weights
 
 
-def init_collate_fun(tokenizer, return_items=False):
-    return functools.partial(collate_fun, tokenizer=tokenizer, return_items=return_items)
+def init_collate_fun(tokenizer, return_items=False, *, pack_sequences=False, max_seq_len=384, pin_memory=False,
+                     share_memory=False, pad_multiple=1):
+    if pack_sequences:
+        logger.info(f'Items are packed into rows of {max_seq_len} tokens.')
+        return functools.partial(packed_collate_fun, tokenizer=tokenizer, max_seq_len=max_seq_len,
+                                 return_items=return_items, pin_memory=pin_memory, share_memory=share_memory,
+                                 pad_multiple=pad_multiple)
+
+    return functools.partial(collate_fun, tokenizer=tokenizer, return_items=return_items, pin_memory=pin_memory,
+                             share_memory=share_memory, pad_multiple=pad_multiple)
@@ -1,12 +1,21 @@
-from .split_dataset import collate_fun, RawPreprocessor, DatasetItem, SplitDataset
+from .split_dataset import collate_fun, packed_collate_fun, RawPreprocessor, DatasetItem, SplitDataset
 from .validation_dataset import ChunkItem, ChunkDataset
 from .dummy_dataset import DummyDataset
+from .storage import ShardedStorage
+from .tokenized_cache import TokenizedCache
+from .chunk_index import ChunkIndex
+from .streaming_dataset import StreamingDataset
 
 
 __all__ = [collate_fun,
+           packed_collate_fun,
            RawPreprocessor,
            DatasetItem,
            SplitDataset,
            ChunkItem,
-           ChunkDataset
+           ChunkDataset,
+           ShardedStorage,
+           TokenizedCache,
+           ChunkIndex,
+           StreamingDataset
            ]
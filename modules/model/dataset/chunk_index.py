@@ -0,0 +1,256 @@
+import json
+import logging
+import multiprocessing as mp
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from .chunking import get_window_targets, plan_sentence_windows, plan_stride_windows
+from .split_dataset import RawPreprocessor
+from .tokenized_cache import _without_dropout
+
+logger = logging.getLogger(__name__)
+
+# state of indexing workers, it is set once by pool initializer
+_worker_state = {}
+
+
+class ChunkIndex(object):
+    version = 3
+
+    # start_id and end_id are answer positions in model input (-1 if the answer is not in the chunk),
+    # n_tokens is length of model input
+    dtype = np.dtype([('doc_id', np.int64),
+                      ('doc_start', np.int32),
+                      ('doc_end', np.int32),
+                      ('n_sents', np.int32),
+                      ('start_id', np.int32),
+                      ('end_id', np.int32),
+                      ('label_id', np.int8),
+                      ('n_tokens', np.int32)])
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+
+        self.meta = ChunkIndex._load_meta(self.index_dir)
+
+        self._arrays = None
+
+    @staticmethod
+    def get_index_dir(cache, *, max_seq_len, max_question_len, doc_stride):
+        # tokenized cache directory depends on tokenizer and splitting mode
+        return cache.cache_dir / f'chunks_{max_seq_len}_{max_question_len}_{doc_stride}'
+
+    @classmethod
+    def load_or_build(cls, storage, cache, tokenizer, *, max_seq_len=384, max_question_len=64, doc_stride=128,
+                      n_jobs=1):
+        index_dir = ChunkIndex.get_index_dir(cache, max_seq_len=max_seq_len, max_question_len=max_question_len,
+                                             doc_stride=doc_stride)
+
+        meta = ChunkIndex._load_meta(index_dir)
+        if meta.get('version') == cls.version and meta.get('storage_fingerprint') == storage.fingerprint \
+                and meta.get('n_docs') == len(storage):
+            logger.info(f'Chunk index was loaded from {index_dir}.')
+        else:
+            cls.build(index_dir, storage, cache, tokenizer, max_seq_len=max_seq_len,
+                      max_question_len=max_question_len, doc_stride=doc_stride, n_jobs=n_jobs)
+
+        return cls(index_dir)
+
+    @staticmethod
+    def _load_meta(index_dir):
+        meta_path = Path(index_dir) / 'meta.json'
+        if not meta_path.exists():
+            return {}
+
+        with open(meta_path, 'r') as in_file:
+            return json.load(in_file)
+
+    @staticmethod
+    def _get_document_chunks(doc_id, line, document, question_len, *, max_seq_len, doc_stride, split_by_sentence):
+        document_len = max_seq_len - question_len - 3  # [CLS], [SEP], [SEP]
+
+        class_label, start_position, end_position = RawPreprocessor._get_target(line)
+
+        assert start_position <= end_position, 'Before mapping.'
+
+        start_position = int(document.o2t[start_position])
+        end_position = int(document.o2t[end_position])
+
+        assert start_position <= end_position, 'After mapping.'
+
+        if split_by_sentence:
+            doc_starts, doc_ends, n_sents = plan_sentence_windows(document.sentence_bounds, document_len)
+        else:
+            doc_starts, doc_ends = plan_stride_windows(len(document.input_ids), document_len, doc_stride)
+            n_sents = np.zeros_like(doc_starts)
+
+        contains, starts, ends = get_window_targets(doc_starts, doc_ends, start_position, end_position,
+                                                    question_len + 2)
+
+        chunks = np.zeros(len(doc_starts), dtype=ChunkIndex.dtype)
+        chunks['doc_id'] = doc_id
+        chunks['doc_start'] = doc_starts
+        chunks['doc_end'] = doc_ends
+        chunks['n_sents'] = n_sents
+        chunks['start_id'] = starts
+        chunks['end_id'] = ends
+        chunks['label_id'] = np.where(contains, RawPreprocessor.labels2id[class_label],
+                                      RawPreprocessor.labels2id['unknown'])
+        chunks['n_tokens'] = np.minimum(doc_ends, len(document.input_ids)) - doc_starts + question_len + 3
+
+        return chunks
+
+    @staticmethod
+    def _init_worker(storage, cache, tokenizer, params):
+        _worker_state['storage'] = storage
+        _worker_state['cache'] = cache
+        _worker_state['tokenizer'] = tokenizer
+        _worker_state['params'] = params
+
+    @staticmethod
+    def _index_shard(args):
+        shard_id, start, end = args
+
+        storage, cache, tokenizer = _worker_state['storage'], _worker_state['cache'], _worker_state['tokenizer']
+        max_seq_len, max_question_len, doc_stride = _worker_state['params']
+
+        chunks, questions, example_ids = [], [], []
+        for doc_id, line in zip(range(start, end), storage.read_block(np.arange(start, end))):
+            encoded_question = tokenizer.encode(line['question_text'])[:max_question_len]
+            chunks.append(ChunkIndex._get_document_chunks(doc_id, line, cache[doc_id], len(encoded_question),
+                                                          max_seq_len=max_seq_len,
+                                                          doc_stride=doc_stride,
+                                                          split_by_sentence=cache.split_by_sentence))
+            questions.append(np.asarray(encoded_question, dtype=np.int32))
+            example_ids.append(str(line['example_id']))
+
+        return shard_id, chunks, questions, example_ids
+
+    @staticmethod
+    def build(index_dir, storage, cache, tokenizer, *, max_seq_len=384, max_question_len=64, doc_stride=128,
+              n_jobs=1, shard_size=1024):
+        index_dir = Path(index_dir)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.makedirs(index_dir)
+
+        # questions are encoded once by deterministic tokenizer like documents of tokenized cache
+        tokenizer = _without_dropout(tokenizer)
+
+        n_docs = len(storage)
+        shards = [(shard_id, start, min(start + shard_size, n_docs))
+                  for shard_id, start in enumerate(range(0, n_docs, shard_size))]
+
+        results = [None] * len(shards)
+        tqdm_data = tqdm(total=n_docs, desc='Indexing chunks')
+
+        init_args = (storage, cache, tokenizer, (max_seq_len, max_question_len, doc_stride))
+        if n_jobs <= 1:
+            ChunkIndex._init_worker(*init_args)
+            shard_results = map(ChunkIndex._index_shard, shards)
+            pool = None
+        else:
+            # initializer arguments are inherited by forked workers, so tokenizer is not pickled
+            pool = mp.Pool(n_jobs, initializer=ChunkIndex._init_worker, initargs=init_args)
+            shard_results = pool.imap_unordered(ChunkIndex._index_shard, shards)
+
+        try:
+            for shard_id, *shard_result in shard_results:
+                results[shard_id] = shard_result
+                tqdm_data.update(len(shard_result[0]))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _worker_state.clear()
+            tqdm_data.close()
+
+        # arrays of documents are concatenated in document order
+        doc_chunks = [doc_chunks for shard_chunks, _, _ in results for doc_chunks in shard_chunks]
+        questions = [question for _, shard_questions, _ in results for question in shard_questions]
+        example_ids = [example_id for _, _, shard_example_ids in results for example_id in shard_example_ids]
+
+        chunks = np.concatenate(doc_chunks) if doc_chunks else np.zeros(0, dtype=ChunkIndex.dtype)
+
+        offsets = np.zeros(n_docs + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in doc_chunks], out=offsets[1:])
+
+        question_offsets = np.zeros(n_docs + 1, dtype=np.int64)
+        np.cumsum([len(q) for q in questions], out=question_offsets[1:])
+
+        np.save(index_dir / 'chunks.npy', chunks)
+        np.save(index_dir / 'offsets.npy', offsets)
+        np.save(index_dir / 'questions.npy', np.concatenate(questions) if questions else np.zeros(0, dtype=np.int32))
+        np.save(index_dir / 'question_offsets.npy', question_offsets)
+        np.save(index_dir / 'example_ids.npy', np.asarray(example_ids, dtype=np.str_))
+
+        # meta file is written last and marks the index as complete
+        with open(index_dir / 'meta.json', 'w') as out_file:
+            json.dump({'version': ChunkIndex.version,
+                       'max_seq_len': max_seq_len,
+                       'max_question_len': max_question_len,
+                       'doc_stride': doc_stride,
+                       'split_by_sentence': cache.split_by_sentence,
+                       'storage_fingerprint': storage.fingerprint,
+                       'n_docs': n_docs,
+                       'n_chunks': len(chunks)}, out_file)
+
+        logger.info(f'{len(chunks)} chunks of {n_docs} documents were indexed into {index_dir}.')
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            # chunks of document i are chunks[offsets[i]:offsets[i + 1]], its encoded question is
+            # questions[question_offsets[i]:question_offsets[i + 1]]
+            self._arrays = {name: np.load(self.index_dir / f'{name}.npy', mmap_mode='r')
+                            for name in ('chunks', 'offsets', 'questions', 'question_offsets', 'example_ids')}
+
+        return self._arrays
+
+    @property
+    def chunks(self):
+        return self._get_arrays()['chunks']
+
+    @property
+    def offsets(self):
+        return self._get_arrays()['offsets']
+
+    def get_question(self, doc_id):
+        arrays = self._get_arrays()
+        start, end = arrays['question_offsets'][doc_id], arrays['question_offsets'][doc_id + 1]
+
+        return arrays['questions'][start:end]
+
+    def get_example_id(self, doc_id):
+        return str(self._get_arrays()['example_ids'][doc_id])
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every process
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+
+        return state
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def get_chunk_ids(self, doc_ids):
+        """
+        Returns ids of all chunks of documents and position of document in doc_ids for every chunk.
+        """
+
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+
+        starts = self.offsets[doc_ids]
+        lengths = self.offsets[doc_ids + 1] - starts
+
+        # concatenation of ranges [start, start + length) of all documents
+        doc_positions = np.repeat(np.arange(len(doc_ids)), lengths)
+        chunk_ids = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(np.sum(lengths))
+
+        return chunk_ids, doc_positions
+
+    def __getitem__(self, idx):
+        return self.chunks[idx]
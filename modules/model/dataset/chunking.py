@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def plan_sentence_windows(sentence_bounds, max_len):
+    """
+    Splits document into windows of consecutive sentences. Window is extended by sentences while it fits max_len
+    tokens, then it is emitted and its first sentences are dropped until the next sentence fits.
+    Sentence i is tokens[sentence_bounds[i]:sentence_bounds[i + 1]].
+    Returns token starts and ends of windows and number of sentences in every window.
+    """
+
+    sentence_bounds = np.asarray(sentence_bounds, dtype=np.int64)
+    n_sents = len(sentence_bounds) - 1
+
+    firsts = np.arange(n_sents)
+    # window which starts from sentence i is emitted before the first sentence which does not fit into it
+    lasts = np.maximum(firsts + 1, np.searchsorted(sentence_bounds[1:], sentence_bounds[:-1] + max_len, side='right'))
+
+    # windows are emitted only before the end of document, the rest sentences are the tail window
+    n_windows = int(np.sum(lasts < n_sents))
+    firsts = np.append(firsts[:n_windows], n_windows)
+    lasts = np.append(lasts[:n_windows], n_sents)
+
+    return sentence_bounds[firsts], sentence_bounds[lasts], lasts - firsts
+
+
+def get_window_targets(doc_starts, doc_ends, start_position, end_position, offset):
+    """
+    Computes answer positions inside of windows. Offset is a number of tokens before document in model input.
+    Returns mask of windows which contain the answer and answer start/end inside of them (-1 if it is absent).
+    """
+
+    contains = (doc_starts <= start_position) & (end_position <= doc_ends)
+
+    starts = np.where(contains, start_position - doc_starts + offset, -1)
+    ends = np.where(contains, end_position - doc_starts + offset, -1)
+
+    return contains, starts, ends
+
+
+def plan_stride_windows(n_tokens, max_len, doc_stride, *, first_only=False):
+    """
+    Splits document into windows of max_len tokens which start every doc_stride tokens.
+    Returns token starts and ends of windows, ends are not clipped by the document length.
+    """
+
+    doc_starts = np.arange(0, n_tokens, doc_stride, dtype=np.int64)
+    if first_only:
+        doc_starts = doc_starts[:1]
+
+    return doc_starts, doc_starts + max_len
+
+
+def plan_packing(lengths, max_len):
+    """
+    Packs sequences into rows of max_len tokens with first fit decreasing strategy.
+    Returns row and offset inside of the row for every sequence and number of rows.
+    """
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    assert np.all(lengths <= max_len), f'Sequences are longer than row length {max_len}.'
+
+    rows = np.zeros(len(lengths), dtype=np.int64)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+
+    row_lens = []
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        for row_i, row_len in enumerate(row_lens):
+            if row_len + lengths[i] <= max_len:
+                break
+        else:
+            row_i = len(row_lens)
+            row_lens.append(0)
+
+        rows[i], offsets[i] = row_i, row_lens[row_i]
+        row_lens[row_i] += lengths[i]
+
+    return rows, offsets, len(row_lens)
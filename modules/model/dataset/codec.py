@@ -0,0 +1,69 @@
+import importlib.util
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+orjson = importlib.util.find_spec('orjson')
+if orjson is not None:
+    orjson = importlib.import_module('orjson')
+
+msgpack = importlib.util.find_spec('msgpack')
+if msgpack is not None:
+    msgpack = importlib.import_module('msgpack')
+
+
+class JsonCodec(object):
+    name = 'json'
+
+    @staticmethod
+    def encode(record):
+        return json.dumps(record).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    name = 'orjson'
+
+    @staticmethod
+    def encode(record):
+        return orjson.dumps(record)
+
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(record):
+        return msgpack.packb(record, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {'json': (JsonCodec, json),
+          'orjson': (OrjsonCodec, orjson),
+          'msgpack': (MsgpackCodec, msgpack)}
+
+
+def available_codecs():
+    return [name for name, (_, module) in CODECS.items() if module is not None]
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise NotImplementedError(f'Codec {name} is not implemented. Available codecs: {", ".join(CODECS)}.')
+
+    codec, module = CODECS[name]
+    if module is None:
+        raise ImportError(f'Install {name} module to use {codec.__name__}.')
+
+    return codec
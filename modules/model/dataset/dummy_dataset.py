@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 from .split_dataset import DatasetItem
 
@@ -9,6 +10,7 @@ class DummyDataset:
                  *args,
                  max_seq_len=384,
                  max_question_len=64,
+                 min_seq_len=None,
                  dataset_len=10000,
                  **kwargs):
 
@@ -18,6 +20,10 @@ class DummyDataset:
         self.max_seq_len = max_seq_len
         self.max_question_len = max_question_len
 
+        # items have random lengths from [min_seq_len, max_seq_len] if min_seq_len is set
+        self.lengths = np.full(self.dataset_len, self.max_seq_len, dtype=np.int64) if min_seq_len is None else \
+            np.random.randint(max(min_seq_len, self.max_question_len + 3), self.max_seq_len + 1, self.dataset_len)
+
         self.w_ids = [self.tokenizer.pad_token_id,
                       self.tokenizer.sep_token_id,
                       self.tokenizer.cls_token_id] if tokenizer is not None else None
@@ -25,6 +31,9 @@ class DummyDataset:
     def __len__(self):
         return self.dataset_len
 
+    def get_lengths(self):
+        return self.lengths
+
     def _delete_special(self, ids):
         assert self.w_ids is not None, f'Dataset {type(self).__name__} was initialized with None tokenizer.'
 
@@ -33,8 +42,8 @@ class DummyDataset:
 
         return ids
 
-    def __getitem__(self, *args):
-        document_len = self.max_seq_len - self.max_question_len - 3
+    def __getitem__(self, idx):
+        document_len = self.lengths[idx] - self.max_question_len - 3
 
         question_ids = self._delete_special(np.random.randint(1, len(self.tokenizer), self.max_question_len)).tolist()
         document_ids = self._delete_special((np.random.randint(1, len(self.tokenizer), document_len))).tolist()
@@ -44,8 +53,43 @@ class DummyDataset:
 
         return DatasetItem(input_ids=input_ids,
                            start_id=0,
-                           end_id=self.max_seq_len-1,
+                           end_id=len(input_ids) - 1,
                            label_id=0,
                            example_id='None',
                            start_position=0,
-                           end_position=1)
+                           end_position=1,
+                           question_len=self.max_question_len)
+
+    def get_batch(self, idxs):
+        """
+        Generates collated batch of items with indexes idxs at once, it has the same tensors as collate_fun output.
+        """
+
+        lengths = self.lengths[idxs]
+        batch_size, max_len = len(lengths), int(np.max(lengths))
+
+        positions = np.arange(max_len)
+        token_mask = positions < lengths[:, np.newaxis]
+        sep_positions = self.max_question_len + 1
+
+        input_ids = self._delete_special(np.random.randint(1, len(self.tokenizer), (batch_size, max_len)))
+        input_ids[:, 0] = self.tokenizer.cls_token_id
+        input_ids[:, sep_positions] = self.tokenizer.sep_token_id
+        input_ids[np.arange(batch_size), lengths - 1] = self.tokenizer.sep_token_id
+        input_ids[~token_mask] = self.tokenizer.pad_token_id
+
+        token_type_ids = np.zeros((batch_size, max_len), dtype=np.int64)
+        if self.tokenizer.model_name == 'bert':
+            token_type_ids[...] = positions > sep_positions
+
+        inputs = {'input_ids': torch.from_numpy(input_ids),
+                  'attention_mask': torch.from_numpy(token_mask),
+                  'token_type_ids': torch.from_numpy(token_type_ids)}
+
+        labels = {'start_class': torch.zeros(batch_size, dtype=torch.int64),
+                  'end_class': torch.from_numpy(lengths - 1),
+                  'start_reg': torch.zeros(batch_size, dtype=torch.float32),
+                  'end_reg': torch.ones(batch_size, dtype=torch.float32),
+                  'cls': torch.zeros(batch_size, dtype=torch.int64)}
+
+        return [inputs, labels]
@@ -0,0 +1,93 @@
+import itertools
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+import nltk
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TAG_PATTERN = re.compile(r'<.+>')
+
+
+@dataclass
+class EncodedDocument(object):
+    input_ids: np.ndarray
+    o2t: np.ndarray
+    t2o: np.ndarray
+    # token offsets of sentences: sentence i is input_ids[sentence_bounds[i]:sentence_bounds[i + 1]]
+    sentence_bounds: Optional[np.ndarray] = None
+
+
+def load_sentence_tokenizer():
+    try:
+        sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+    except Exception as e:
+        logger.warning('Data for sentence tokenizer will be downloaded. To prevent it in future, '
+                       'download the required package in your env with: '
+                       '\n\t import nltk \n\t nltk.download("punkt")')
+
+        nltk.download('punkt')
+
+        sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+
+    return sentence_tokenizer
+
+
+def encode_words(tokenizer, words):
+    if hasattr(tokenizer, 'encode_words'):
+        return tokenizer.encode_words(words)
+
+    # slow tokenizers are called word by word
+    encoded_words = [tokenizer.encode(word) for word in words]
+    lengths = np.asarray([len(word_tokens) for word_tokens in encoded_words], dtype=np.int64)
+
+    return np.fromiter(itertools.chain.from_iterable(encoded_words), dtype=np.int32, count=int(lengths.sum())), \
+        lengths
+
+
+def drop_tags_and_encode(tokenizer, text, *, history_len=0, start=-1):
+    text = text.split()
+
+    is_word = np.fromiter((TAG_PATTERN.match(word) is None for word in text), dtype=np.bool_, count=len(text))
+    tokenized_text, word_lengths = encode_words(tokenizer,
+                                                [word for word, word_flag in zip(text, is_word) if word_flag])
+
+    # number of tokens of every word, tags are dropped
+    lengths = np.zeros(len(text), dtype=np.int64)
+    lengths[is_word] = word_lengths
+
+    o2t = (history_len + np.cumsum(lengths) - lengths).astype(np.int32)
+    t2o = np.repeat(np.arange(start + 1, start + 1 + len(text), dtype=np.int32), lengths)
+
+    word_i = start + len(text) if text else 0
+
+    return tokenized_text, o2t, t2o, history_len + len(tokenized_text), word_i
+
+
+def encode_document(tokenizer, text, *, sentence_tokenizer=None):
+    if sentence_tokenizer is None:
+        input_ids, o2t, t2o, _, _ = drop_tags_and_encode(tokenizer, text)
+        sentence_bounds = None
+    else:
+        input_ids, o2t, t2o, sentence_bounds = [], [], [], [0]
+
+        start = -1
+        history = 0
+        for sen in sentence_tokenizer.tokenize(text):
+            sen_ids, sen_o2t, sen_t2o, history, start = drop_tags_and_encode(tokenizer, sen,
+                                                                             history_len=history,
+                                                                             start=start)
+            input_ids.append(sen_ids)
+            o2t.append(sen_o2t)
+            t2o.append(sen_t2o)
+
+            sentence_bounds.append(history)
+
+        input_ids, o2t, t2o = (np.concatenate(array) if array else np.zeros(0, dtype=np.int32)
+                               for array in (input_ids, o2t, t2o))
+        sentence_bounds = np.asarray(sentence_bounds, dtype=np.int32)
+
+    return EncodedDocument(input_ids=input_ids, o2t=o2t, t2o=t2o, sentence_bounds=sentence_bounds)
@@ -1,82 +1,332 @@
+import glob
+import gzip
+import hashlib
+import importlib.util
+import io
+import itertools
 import json
-import linecache
 import logging
+import multiprocessing as mp
 import os
 import pickle
-import re
-import subprocess
-from collections import defaultdict
+import shutil
+import tempfile
+from collections import Counter, defaultdict
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List
 
-import nltk
 import numpy as np
 import torch
 from sklearn.model_selection import train_test_split
 from tqdm.auto import tqdm
 
+from .chunking import get_window_targets, plan_packing, plan_sentence_windows, plan_stride_windows
+from .encoding import TAG_PATTERN, encode_document, load_sentence_tokenizer
+from .storage import ShardedStorage, ShardWriter, SharedArrays
+
 logger = logging.getLogger(__file__)
 
+zstandard = importlib.util.find_spec('zstandard')
+if zstandard is not None:
+    zstandard = importlib.import_module('zstandard')
+
 
 class LineDataExtractor(object):
-    def __init__(self, data_path):
-        self.data_path = data_path
+    progress_unit = 'lines'
 
-        logger.info(f'Loading number of lines in file {self.data_path}...')
-        self.num_lines = int(subprocess.check_output('wc -l ' + self.data_path, shell=True).split()[0])
+    def __init__(self, data_path, *, index_path=None, index_dir=None, buffer_size=16 * 1024 * 1024):
+        self.data_path = str(data_path)
+        self.index_path = LineDataExtractor._get_index_path(self.data_path, index_dir) if index_path is None \
+            else Path(index_path)
+        self.buffer_size = buffer_size
+
+        # offsets[i] is the first byte of line i, offsets[-1] is the file size
+        self.offsets = self._load_index()
+        self.num_lines = len(self.offsets) - 1
         logger.info(f'Line number is {self.num_lines}.')
 
-        self.line_i = 0
+        self._fd = None
+        self._fd_pid = None
+
+    @staticmethod
+    def _get_index_path(data_path, index_dir):
+        # index is kept next to the raw file unless its directory is read-only (e.g. mounted data)
+        data_dir, index_name = os.path.split(os.path.abspath(f'{data_path}.index.npy'))
+        if not os.access(data_dir, os.W_OK):
+            data_dir = tempfile.gettempdir() if index_dir is None else index_dir
+
+        return Path(data_dir) / index_name
+
+    def _load_index(self):
+        data_size = os.path.getsize(self.data_path)
+
+        if self.index_path.exists() and os.path.getmtime(self.index_path) >= os.path.getmtime(self.data_path):
+            offsets = np.load(self.index_path, mmap_mode='r')
+            if len(offsets) and offsets[-1] == data_size:
+                logger.info(f'Line index was loaded from {self.index_path}.')
+                return offsets
+
+            logger.warning(f'Line index {self.index_path} does not match {self.data_path} and will be rebuilt.')
+
+        logger.info(f'Building line index of file {self.data_path}...')
+        offsets = self._build_index(data_size)
+
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        with open(tmp_path, 'wb') as out_file:
+            np.save(out_file, offsets)
+        os.replace(tmp_path, self.index_path)
+        logger.info(f'Line index was dumped to {self.index_path}.')
+
+        return np.load(self.index_path, mmap_mode='r')
+
+    def _build_index(self, data_size):
+        offsets = [np.zeros(1, dtype=np.uint64)]
+
+        with open(self.data_path, 'rb', buffering=0) as in_file:
+            position = 0
+            while True:
+                buffer = in_file.read(self.buffer_size)
+                if not buffer:
+                    break
+
+                new_lines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord('\n'))
+                offsets.append((new_lines + position + 1).astype(np.uint64))
+                position += len(buffer)
+
+        offsets = np.concatenate(offsets)
+        if offsets[-1] != data_size:
+            # the last line does not end with a new line symbol
+            offsets = np.append(offsets, np.uint64(data_size))
+
+        return offsets
+
+    def _get_fd(self):
+        # file descriptors are not shared between forked processes
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self.data_path, os.O_RDONLY)
+            self._fd_pid = os.getpid()
+
+        return self._fd
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_fd_pid'] = None
+
+        return state
+
+    def __del__(self):
+        if getattr(self, '_fd', None) is not None and self._fd_pid == os.getpid():
+            os.close(self._fd)
 
     def __len__(self):
         return self.num_lines
 
     def __iter__(self):
-        return self
+        with open(self.data_path, 'rb', buffering=self.buffer_size) as in_file:
+            for line in in_file:
+                yield json.loads(line)
+
+    def iter_range_bytes(self, start, end):
+        with open(self.data_path, 'rb', buffering=self.buffer_size) as in_file:
+            in_file.seek(int(self.offsets[start]))
+            for _ in range(start, end):
+                yield in_file.readline()
+
+    def get_shards(self, n_jobs, *, shard_size=None, exclude=()):
+        # lines which are not covered by excluded (already processed) shards
+        ranges = []
+        position = 0
+        for start, end in sorted(exclude):
+            if start > position:
+                ranges.append((position, start))
+            position = max(position, end)
+        if position < self.num_lines:
+            ranges.append((position, self.num_lines))
+
+        if shard_size is None:
+            # several shards per job to balance the load between processes
+            n_lines = sum(end - start for start, end in ranges)
+            shard_size = max(int(np.ceil(n_lines / (8 * n_jobs))), 1)
+
+        return [(shard_start, min(shard_start + shard_size, end))
+                for start, end in ranges for shard_start in range(start, end, shard_size)]
 
-    def __next__(self):
-        if self.line_i < self.num_lines:
-            line = json.loads(linecache.getline(self.data_path, self.line_i + 1))
-            self.line_i += 1
-            return line
-        else:
-            raise StopIteration
+    @staticmethod
+    def load_shard(shard):
+        # shards are stored in the manifest as json lists
+        return tuple(shard)
+
+    def has_shard(self, shard):
+        start, end = shard
+
+        return 0 <= start < end <= self.num_lines
+
+    def shard_source(self, shard):
+        return self.data_path
+
+    def source_info(self):
+        return {self.data_path: {'size': os.path.getsize(self.data_path),
+                                 'mtime': os.path.getmtime(self.data_path)}}
+
+    def shard_progress(self, shard):
+        start, end = shard
+
+        return end - start
+
+    def iter_shard_bytes(self, shard, *, progress=None):
+        for line in self.iter_range_bytes(*shard):
+            yield line
+            if progress is not None:
+                progress(1)
+
+    def iter_shard(self, shard, *, progress=None):
+        for line in self.iter_shard_bytes(shard, progress=progress):
+            yield json.loads(line)
+
+    def read_bytes(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+
+        return os.pread(self._get_fd(), end - start, start)
 
     def __getitem__(self, idx):
-        return json.loads(linecache.getline(self.data_path, idx + 1))
+        return json.loads(self.read_bytes(idx))
+
+
+class StreamDataExtractor(object):
+    progress_unit = 'B'
+
+    def __init__(self, data_pattern, *, buffer_size=16 * 1024 * 1024):
+        self.data_pattern = str(data_pattern)
+        self.buffer_size = buffer_size
+
+        self.data_paths = sorted(glob.glob(self.data_pattern))
+        if not self.data_paths:
+            raise FileNotFoundError(f'No files match {self.data_pattern}.')
+
+        logger.info(f'{len(self.data_paths)} files will be read as a stream from {self.data_pattern}.')
+
+    @staticmethod
+    def is_stream(data_path):
+        data_path = str(data_path)
+
+        return glob.has_magic(data_path) or data_path.endswith(('.gz', '.zst'))
+
+    def _open(self, raw_file, data_path):
+        if data_path.endswith('.gz'):
+            stream = gzip.GzipFile(fileobj=raw_file, mode='rb')
+        elif data_path.endswith('.zst'):
+            if zstandard is None:
+                raise ImportError(f'Install zstandard module to read {data_path}.')
+            stream = zstandard.ZstdDecompressor().stream_reader(raw_file)
+        else:
+            return raw_file
+
+        return io.BufferedReader(stream, buffer_size=self.buffer_size)
+
+    def get_shards(self, n_jobs, *, shard_size=None, exclude=()):
+        # compressed files can be read only sequentially, so every file is a shard
+        exclude = set(exclude)
+
+        return [data_path for data_path in self.data_paths if data_path not in exclude]
+
+    @staticmethod
+    def load_shard(shard):
+        return shard
+
+    def has_shard(self, shard):
+        return shard in self.data_paths
+
+    def shard_source(self, shard):
+        return shard
+
+    def source_info(self):
+        return {data_path: {'size': os.path.getsize(data_path), 'mtime': os.path.getmtime(data_path)}
+                for data_path in self.data_paths}
+
+    def shard_progress(self, shard):
+        return os.path.getsize(shard)
+
+    def iter_shard_bytes(self, shard, *, progress=None):
+        with open(shard, 'rb', buffering=self.buffer_size) as raw_file:
+            position = 0
+            for line in self._open(raw_file, shard):
+                yield line
+
+                # progress is measured in bytes of the compressed file
+                if progress is not None and raw_file.tell() != position:
+                    progress(raw_file.tell() - position)
+                    position = raw_file.tell()
+
+    def iter_shard(self, shard, *, progress=None):
+        for line in self.iter_shard_bytes(shard, progress=progress):
+            yield json.loads(line)
+
+    def __iter__(self):
+        for data_path in self.data_paths:
+            yield from self.iter_shard(data_path)
 
 
 class RawPreprocessor(object):
     labels2id = {k: i for i, k in enumerate(['yes', 'no', 'short', 'long', 'unknown'])}
     id2labels = {i: k for k, i in labels2id.items()}
 
-    def __init__(self, raw_json, out_dir, *, clear=False):
+    manifest_version = 2
+
+    split_strategies = ('random', 'hash')
+    test_size = 0.05
+
+    # number of the most frequent words which are kept for tokenizer cache, counter of shard is pruned to them
+    # when it exceeds word_counts_buffer_size words
+    word_counts_size = 100000
+    word_counts_buffer_size = 4 * word_counts_size
+
+    def __init__(self, raw_json, out_dir, *, clear=False, n_jobs=1, shard_size=None, codec='json',
+                 split_strategy='random', count_words=False):
 
         self.raw_json = raw_json
         self.out_dir = out_dir
+        self.codec = codec
+        # word counts are read only by tokenizer cache
+        self.count_words = count_words
+
+        if split_strategy not in self.split_strategies:
+            raise NotImplementedError(f'Split strategy {split_strategy} is not supported.')
+        self.split_strategy = split_strategy
+
+        self.n_jobs = max(n_jobs, 1)
+        self.shard_size = shard_size
 
         if isinstance(self.out_dir, str):
             self.out_dir = Path(self.out_dir)
 
         os.makedirs(self.out_dir, exist_ok=True)
 
-        self.data_extractor = LineDataExtractor(self.raw_json)
-
         self.label_info_path = self.out_dir / 'label.info'
         self.split_info_path = self.out_dir / 'split.info'
+        # processed shards with hashes of their raw content
+        self.manifest_path = self.out_dir / 'manifest.json'
+        # the most frequent words of documents
+        self.word_counts_path = self.out_dir / 'word_counts.json'
 
         if clear:
             rm_files = self.out_dir.glob('*')
             for rm_file in rm_files:
-                os.remove(rm_file)
+                if rm_file.is_dir():
+                    shutil.rmtree(rm_file)
+                else:
+                    os.remove(rm_file)
+
+        # line index of read-only raw file is kept in output directory, so it is created after clearing
+        self.data_extractor = StreamDataExtractor(self.raw_json) if StreamDataExtractor.is_stream(self.raw_json) \
+            else LineDataExtractor(self.raw_json, index_dir=self.out_dir)
 
     @staticmethod
     def _process_line(raw_line):
+        # only fields which are read by datasets are kept
         line = {}
 
-        document_text = raw_line['document_text'].split()
-
         line['document_text'] = raw_line['document_text']
         line['question_text'] = raw_line['question_text']
         line['example_id'] = raw_line['example_id']
@@ -85,16 +335,11 @@ class RawPreprocessor(object):
 
         line['yes_no_answer'] = annotations['yes_no_answer']
 
-        start = annotations['long_answer']['start_token']
-        end = annotations['long_answer']['end_token']
-        line['long_answer'] = 'NONE' if start == end else document_text[start:end]
-        line['long_answer_start'] = start
-        line['long_answer_end'] = end
+        line['long_answer_start'] = annotations['long_answer']['start_token']
+        line['long_answer_end'] = annotations['long_answer']['end_token']
         line['long_answer_index'] = annotations['long_answer']['candidate_index']
 
-        line['short_answers'] = annotations['short_answers']
-
-        line['long_answer_candidates'] = raw_line['long_answer_candidates']
+        line['short_answers'] = [(a['start_token'], a['end_token']) for a in annotations['short_answers']]
 
         return line
 
@@ -107,9 +352,7 @@ class RawPreprocessor(object):
         elif line['short_answers']:
             class_label = 'short'
             # todo: find optimal interval
-            short_answers = line['short_answers']
-            start_position = short_answers[0]['start_token']
-            end_position = short_answers[0]['end_token']
+            start_position, end_position = line['short_answers'][0]
         elif line['long_answer_index'] != -1:
             class_label = 'long'
             start_position = line['long_answer_start']
@@ -121,66 +364,338 @@ class RawPreprocessor(object):
 
         return class_label, start_position, end_position
 
-    def __call__(self):
-        if self.label_info_path.exists():
-            with open(self.label_info_path, 'rb') as in_file:
-                labels_counter, labels = pickle.load(in_file)
-            logging.info(f'Labels info was loaded from {self.label_info_path}.')
+    @staticmethod
+    def _split_hash(example_id, label):
+        # hash is salted by label, so documents of every label are split independently
+        digest = hashlib.sha1(f'{label}:{example_id}'.encode('utf-8')).digest()
+
+        return int.from_bytes(digest[:8], 'big')
+
+    @staticmethod
+    def _shard_info_path(out_dir, shard_id):
+        return Path(out_dir) / f'shard_{shard_id:05d}.info.npz'
+
+    @staticmethod
+    def _shard_hash(data_extractor, shard):
+        hasher = hashlib.sha1()
+        for raw_line in data_extractor.iter_shard_bytes(shard):
+            hasher.update(raw_line)
+
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _prune_word_counts(word_counts):
+        # counts of rare words are dropped, so memory of counter is bounded for shards of any size
+        return Counter(dict(word_counts.most_common(RawPreprocessor.word_counts_size)))
+
+    @staticmethod
+    def _process_shard(data_extractor, out_dir, codec, count_words, shard_id, shard, progress=None):
+        hasher = hashlib.sha1()
+        labels = []
+        index = []
+        split_hashes = []
+        word_counts = Counter() if count_words else None
+
+        with ShardWriter(out_dir, shard_id, codec=codec) as writer:
+            for raw_line in data_extractor.iter_shard_bytes(shard, progress=progress):
+                hasher.update(raw_line)
+
+                line = RawPreprocessor._process_line(json.loads(raw_line))
+
+                label = RawPreprocessor.labels2id[RawPreprocessor._get_target(line)[0]]
+
+                labels.append(label)
+                index.append(writer.write(line))
+                split_hashes.append(RawPreprocessor._split_hash(line['example_id'], label))
+
+                if word_counts is not None:
+                    word_counts.update(line['document_text'].split())
+                    if len(word_counts) > RawPreprocessor.word_counts_buffer_size:
+                        word_counts = RawPreprocessor._prune_word_counts(word_counts)
+
+        shard_info = {'labels': np.asarray(labels, dtype=np.float64),
+                      'index': np.asarray(index, dtype=np.uint64).reshape(-1, 3),
+                      'split_hashes': np.asarray(split_hashes, dtype=np.uint64)}
+
+        if word_counts is not None:
+            word_counts = [(word, count) for word, count in word_counts.most_common(RawPreprocessor.word_counts_size)
+                           if not TAG_PATTERN.match(word)]
+            # words do not contain new line symbols, so they are stored as one string
+            shard_info['words'] = np.frombuffer('\n'.join(word for word, _ in word_counts).encode('utf-8'),
+                                                dtype=np.uint8)
+            shard_info['word_counts'] = np.asarray([count for _, count in word_counts], dtype=np.int64)
+
+        # shard info is written after the shard itself, manifest entry is added only after both are complete
+        np.savez(RawPreprocessor._shard_info_path(out_dir, shard_id), **shard_info)
+
+        return {'shard_id': shard_id, 'shard': shard, 'hash': hasher.hexdigest(), 'n_records': len(labels)}
+
+    @staticmethod
+    def _process_shard_star(args):
+        return RawPreprocessor._process_shard(*args)
+
+    def _load_manifest(self):
+        manifest = {'version': self.manifest_version, 'codec': self.codec, 'split_strategy': 'random',
+                    'sources': {}, 'shards': []}
+
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r') as in_file:
+                loaded_manifest = json.load(in_file)
+
+            if loaded_manifest.get('version') == self.manifest_version and loaded_manifest.get('codec') == self.codec:
+                manifest = loaded_manifest
+                logger.info(f'Manifest with {len(manifest["shards"])} processed shards was loaded '
+                            f'from {self.manifest_path}.')
+            else:
+                logger.warning(f'Manifest {self.manifest_path} has another version or codec, '
+                               f'raw data will be processed again.')
+
+        return manifest
+
+    def _dump_manifest(self, manifest):
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        with open(tmp_path, 'w') as out_file:
+            json.dump(manifest, out_file)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _get_valid_shards(self, manifest):
+        sources = self.data_extractor.source_info()
+
+        valid_shards = []
+        for entry in manifest['shards']:
+            shard = self.data_extractor.load_shard(entry['shard'])
+            source = self.data_extractor.shard_source(shard)
+
+            if not self.data_extractor.has_shard(shard) or \
+                    not (self.out_dir / ShardedStorage.shard_name(entry['shard_id'])).exists() or \
+                    not RawPreprocessor._shard_info_path(self.out_dir, entry['shard_id']).exists():
+                is_valid = False
+            elif manifest['sources'].get(source) == sources.get(source):
+                is_valid = True
+            else:
+                # source was modified (e.g. new lines were appended), so shard content is compared by hash
+                is_valid = RawPreprocessor._shard_hash(self.data_extractor, shard) == entry['hash']
+
+            if is_valid:
+                valid_shards.append(dict(entry, shard=shard))
+            else:
+                logger.warning(f'Shard {entry["shard_id"]} ({shard}) does not match raw data '
+                               f'and will be processed again.')
+
+        return valid_shards
+
+    def _remove_unused_shards(self, manifest):
+        shard_ids = {entry['shard_id'] for entry in manifest['shards']}
+
+        for path in self.out_dir.glob('shard_*'):
+            if int(path.name.split('.')[0][len('shard_'):]) not in shard_ids:
+                os.remove(path)
+
+    def _remove_legacy_documents(self):
+        # documents of the old layout were stored as {i}.json files, they are replaced by shards of storage
+        n_removed = 0
+        with os.scandir(self.out_dir) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext == '.json' and name.isdigit() and entry.is_file():
+                    os.remove(entry.path)
+                    n_removed += 1
+
+        if n_removed:
+            logger.info(f'{n_removed} documents of the old layout were removed from {self.out_dir}.')
+
+    def _load_shard_infos(self, manifest, *names):
+        # shards are merged in the order of processing, so new records are appended to the end
+        arrays = {name: [] for name in names}
+        for entry in sorted(manifest['shards'], key=lambda entry: entry['shard_id']):
+            with np.load(RawPreprocessor._shard_info_path(self.out_dir, entry['shard_id'])) as shard_info:
+                for name in names:
+                    arrays[name].append(shard_info[name])
+
+        return [np.concatenate(arrays[name], axis=0) for name in names]
+
+    def _process(self, manifest, shards):
+        first_shard_id = max((entry['shard_id'] for entry in manifest['shards']), default=-1) + 1
+        tasks = [(self.data_extractor, self.out_dir, self.codec, self.count_words, shard_id, shard)
+                 for shard_id, shard in enumerate(shards, start=first_shard_id)]
+
+        logger.info(f'Raw data will be processed in {len(shards)} shards by {self.n_jobs} processes, '
+                    f'{len(manifest["shards"])} shards were processed before.')
+
+        tqdm_data = tqdm(total=sum(self.data_extractor.shard_progress(shard) for shard in shards),
+                         desc='Processing lines', unit=self.data_extractor.progress_unit, unit_scale=True)
+
+        def add_shard(entry):
+            # manifest is updated after every shard, so a killed job is resumed from the last processed shard
+            manifest['shards'].append(entry)
+            self._dump_manifest(manifest)
+
+        if self.n_jobs == 1:
+            for task in tasks:
+                add_shard(RawPreprocessor._process_shard(*task, progress=tqdm_data.update))
         else:
-            labels_counter = defaultdict(int)
-            labels = np.zeros((len(self.data_extractor, )))
+            with mp.Pool(self.n_jobs) as pool:
+                for entry in pool.imap_unordered(RawPreprocessor._process_shard_star, tasks):
+                    add_shard(entry)
+                    tqdm_data.update(self.data_extractor.shard_progress(entry['shard']))
+
+        tqdm_data.close()
+
+        labels, index = self._load_shard_infos(manifest, 'labels', 'index')
+
+        labels_counter = defaultdict(int)
+        for label, count in zip(*np.unique(labels, return_counts=True)):
+            labels_counter[int(label)] += int(count)
+
+        ShardedStorage.write_index(self.out_dir, index, codec=self.codec)
+        if self.count_words:
+            self._dump_word_counts(manifest)
+
+        return labels_counter, labels
+
+    def _dump_word_counts(self, manifest):
+        word_counts = Counter()
+        for entry in manifest['shards']:
+            with np.load(RawPreprocessor._shard_info_path(self.out_dir, entry['shard_id'])) as shard_info:
+                if 'words' not in shard_info.files:
+                    continue
 
-            tqdm_data = tqdm(self.data_extractor, desc='Processing lines')
+                words = bytes(shard_info['words']).decode('utf-8').split('\n') if len(shard_info['words']) else []
+                word_counts.update(dict(zip(words, shard_info['word_counts'].tolist())))
 
-            for line_i, line in enumerate(tqdm_data):
-                line = RawPreprocessor._process_line(line)
+        with open(self.word_counts_path, 'w') as out_file:
+            json.dump(word_counts.most_common(self.word_counts_size), out_file)
+            logger.info(f'Word counts were dumped to {self.word_counts_path}.')
 
-                label = self.labels2id[RawPreprocessor._get_target(line)[0]]
+    @staticmethod
+    def load_word_counts(out_dir):
+        word_counts_path = Path(out_dir) / 'word_counts.json'
+        if not word_counts_path.exists():
+            return []
+
+        with open(word_counts_path, 'r') as in_file:
+            return json.load(in_file)
+
+    def __call__(self):
+        manifest = self._load_manifest()
+        valid_shards = self._get_valid_shards(manifest)
 
-                labels[line_i] = label
-                labels_counter[label] += 1
+        shards = self.data_extractor.get_shards(self.n_jobs, shard_size=self.shard_size,
+                                                exclude=[entry['shard'] for entry in valid_shards])
+        # records keep their positions only if none of the processed shards was dropped
+        keep_split = len(valid_shards) == len(manifest['shards'])
 
-                out_path = self.out_dir / f'{line_i}.json'
+        if not shards and keep_split and self.label_info_path.exists() and ShardedStorage.exists(self.out_dir):
+            with open(self.label_info_path, 'rb') as in_file:
+                labels_counter, labels = pickle.load(in_file)
+            logging.info(f'Labels info was loaded from {self.label_info_path}.')
+        else:
+            manifest['shards'] = valid_shards
+            manifest['sources'] = self.data_extractor.source_info()
+            self._dump_manifest(manifest)
+            self._remove_unused_shards(manifest)
+            self._remove_legacy_documents()
 
-                with open(out_path, 'w') as out_file:
-                    json.dump(line, out_file)
+            labels_counter, labels = self._process(manifest, shards)
 
             with open(self.label_info_path, 'wb') as out_file:
                 pickle.dump((labels_counter, labels), out_file)
                 logger.info(f'Label information was dumped to {self.label_info_path}')
 
-        split_info = self._split_train_test(labels)
+        keep_split = keep_split and manifest['split_strategy'] == self.split_strategy
+        if self.split_strategy == 'hash':
+            split_info = self._split_train_test_by_hash(labels, manifest)
+        else:
+            split_info = self._split_train_test(labels, keep_split=keep_split)
+
+        if manifest['split_strategy'] != self.split_strategy:
+            manifest['split_strategy'] = self.split_strategy
+            self._dump_manifest(manifest)
 
         return labels_counter, labels, split_info
 
-    def _split_train_test(self, labels):
+    def _split_indexes(self, indexes, labels):
+        train_indexes, train_labels, test_indexes, test_labels = [], [], [], []
+        for label_i in range(len(self.labels2id)):
+            mask = (labels == label_i)
+
+            if np.sum(mask) < 2:
+                # there are too few documents to split, so they are used for training
+                train_ids, test_ids, train_l, test_l = indexes[mask], indexes[mask][:0], labels[mask], labels[mask][:0]
+            else:
+                train_ids, test_ids, train_l, test_l = train_test_split(indexes[mask], labels[mask],
+                                                                        test_size=self.test_size, random_state=0)
+
+            train_indexes.append(train_ids)
+            train_labels.append(train_l)
+            test_indexes.append(test_ids)
+            test_labels.append(test_l)
+
+        return np.concatenate(train_indexes, axis=0), np.concatenate(train_labels, axis=0), \
+            np.concatenate(test_indexes, axis=0), np.concatenate(test_labels, axis=0)
+
+    def _dump_split_info(self, split_info):
+        with open(self.split_info_path, 'wb') as out_file:
+            pickle.dump(split_info, out_file)
+            logger.info(f'Split information was dumped to {self.split_info_path}.')
+
+    def _split_train_test_by_hash(self, labels, manifest):
+        # membership of a document depends only on its hash and threshold of its label, so hashes are computed
+        # independently in every shard and documents rarely change their part when new data is added
+        split_hashes, = self._load_shard_infos(manifest, 'split_hashes')
+
+        indexes = np.arange(len(labels))
+
+        train_indexes, train_labels, test_indexes, test_labels = [], [], [], []
+        for label_i in range(len(self.labels2id)):
+            label_indexes = indexes[labels == label_i]
+
+            # per-label threshold is the hash of the first train document, so every label is split by test_size
+            # exactly instead of in expectation
+            n_test = int(round(self.test_size * len(label_indexes)))
+            label_indexes = label_indexes[np.argsort(split_hashes[label_indexes], kind='stable')]
+
+            train_indexes.append(np.sort(label_indexes[n_test:]))
+            test_indexes.append(np.sort(label_indexes[:n_test]))
+            train_labels.append(labels[train_indexes[-1]])
+            test_labels.append(labels[test_indexes[-1]])
+
+        split_info = tuple(np.concatenate(array, axis=0)
+                           for array in (train_indexes, train_labels, test_indexes, test_labels))
+        self._dump_split_info(split_info)
+
+        return split_info
+
+    def _split_train_test(self, labels, *, keep_split=True):
+        n_split = 0
         if self.split_info_path.exists():
             with open(self.split_info_path, 'rb') as in_file:
                 (train_indexes, train_labels, test_indexes, test_labels) = pickle.load(in_file)
-            logger.info(f'Split information was loaded form {self.split_info_path}.')
-        else:
-            indexes = np.arange(len(labels))
 
-            train_indexes, train_labels, test_indexes, test_labels = [], [], [], []
-            for label_i in range(len(self.labels2id)):
-                mask = (labels == label_i)
-
-                train_ids, test_ids, train_l, test_l = train_test_split(indexes[mask], labels[mask],
-                                                                        test_size=0.05, random_state=0)
+            n_split = len(train_indexes) + len(test_indexes)
+            all_indexes = np.concatenate([train_indexes, test_indexes]).astype(np.int64)
 
-                train_indexes.append(train_ids)
-                train_labels.append(train_l)
-                test_indexes.append(test_ids)
-                test_labels.append(test_l)
-
-            train_indexes = np.concatenate(train_indexes, axis=0)
-            train_labels = np.concatenate(train_labels, axis=0)
-            test_indexes = np.concatenate(test_indexes, axis=0)
-            test_labels = np.concatenate(test_labels, axis=0)
+            if keep_split and n_split <= len(labels) and (not n_split or all_indexes.max() < n_split) and \
+                    np.array_equal(labels[all_indexes], np.concatenate([train_labels, test_labels])):
+                logger.info(f'Split information was loaded form {self.split_info_path}.')
+            else:
+                logger.warning(f'Split information {self.split_info_path} does not match labels or split strategy '
+                               f'and will be computed again.')
+                n_split = 0
+
+        if n_split < len(labels):
+            # only new documents are split, so previous assignments are not changed
+            new_split = self._split_indexes(np.arange(n_split, len(labels)), labels[n_split:])
+
+            if n_split:
+                logger.info(f'{len(labels) - n_split} new documents were added to the split.')
+                train_indexes, train_labels, test_indexes, test_labels = \
+                    (np.concatenate([old, new], axis=0) for old, new in
+                     zip((train_indexes, train_labels, test_indexes, test_labels), new_split))
+            else:
+                train_indexes, train_labels, test_indexes, test_labels = new_split
 
-            with open(self.split_info_path, 'wb') as out_file:
-                pickle.dump((train_indexes, train_labels, test_indexes, test_labels), out_file)
-                logger.info(f'Split information was dumped to {self.split_info_path}.')
+            self._dump_split_info((train_indexes, train_labels, test_indexes, test_labels))
 
         assert len(train_indexes) == len(train_labels)
         assert len(test_indexes) == len(test_labels)
@@ -197,6 +712,7 @@ class DatasetItem(object):
     label_id: int
     start_position: float
     end_position: float
+    question_len: int
 
 
 class SplitDataset:
@@ -206,10 +722,15 @@ class SplitDataset:
                  doc_stride=128,
                  test=False,
                  split_by_sentence=False,
-                 truncate=False):
+                 truncate=False,
+                 cache=None,
+                 chunk_index=None,
+                 shared_arrays_dir=None):
         self.data_dir = data_dir
         self.tokenizer = tokenizer
-        self.indexes = indexes
+        self.cache = cache
+        self.chunk_index = chunk_index
+        self.shared_arrays_dir = shared_arrays_dir
 
         self.max_seq_len = max_seq_len
         self.max_question_len = max_question_len
@@ -223,57 +744,111 @@ class SplitDataset:
         if isinstance(self.data_dir, str):
             self.data_dir = Path(self.data_dir)
 
+        self.storage = ShardedStorage(self.data_dir)
+
         self.test = test
         self.truncate = truncate
 
         self.split_by_sentence = split_by_sentence
         if self.split_by_sentence:
             logger.info(f'Documents will be split by sentence.')
-            try:
-                self.sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-            except Exception as e:
-                logger.warning('Data for sentence tokenizer will be downloaded. To prevent it in future, '
-                               'download the required package in your env with: '
-                               '\n\t import nltk \n\t nltk.download("punkt")')
 
-                nltk.download('punkt')
+        if self.cache is not None:
+            assert self.cache.split_by_sentence == self.split_by_sentence, \
+                'Tokenized cache was built for another splitting mode.'
+            logger.info(f'Tokenized documents are read from {self.cache.cache_dir}.')
+
+        self.sentence_tokenizer = load_sentence_tokenizer() if self.split_by_sentence and self.cache is None else None
+
+        chunk_ids, chunk_doc_positions = None, None
+        if self.chunk_index is not None:
+            assert self.cache is not None, 'Chunk index requires tokenized cache.'
+            assert not self.test, 'Chunk index is not used in test mode.'
+            assert self.chunk_index.meta['split_by_sentence'] == self.split_by_sentence, \
+                'Chunk index was built for another splitting mode.'
+
+            # every chunk of every document is a sample
+            chunk_ids, chunk_doc_positions = self.chunk_index.get_chunk_ids(indexes)
+            logger.info(f'Dataset contains {len(chunk_ids)} chunks of {len(indexes)} documents.')
 
-                self.sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+        # index arrays are shared by dataloader workers instead of being copied into every worker
+        self.arrays = SharedArrays({'indexes': np.asarray(indexes, dtype=np.int64),
+                                    'chunk_ids': chunk_ids,
+                                    'chunk_doc_positions': chunk_doc_positions},
+                                   root_dir=self.shared_arrays_dir)
+
+    @property
+    def indexes(self):
+        return self.arrays.get('indexes')
+
+    @property
+    def chunk_ids(self):
+        return self.arrays.get('chunk_ids')
+
+    @property
+    def chunk_doc_positions(self):
+        return self.arrays.get('chunk_doc_positions')
 
     def __len__(self):
+        if self.chunk_ids is not None:
+            return len(self.chunk_ids)
+
         return len(self.indexes)
 
-    @staticmethod
-    def _drop_tags_and_encode(tokenizer, text, *, history_len=0, start=-1):
-        text = text.split()
+    def get_lengths(self):
+        """
+        Returns lengths of model inputs: exact ones for chunk index and upper estimates for tokenized cache.
+        """
+
+        if self.chunk_ids is not None:
+            lengths = self.chunk_index.chunks['n_tokens'][self.chunk_ids]
+        elif self.cache is not None:
+            doc_ids = np.asarray(self.indexes, dtype=np.int64)
+            lengths = self.cache.index[doc_ids + 1, 0] - self.cache.index[doc_ids, 0] + self.max_question_len + 3
+        else:
+            return None
+
+        return np.minimum(lengths, self.max_seq_len) if self.truncate or not self.split_by_sentence else lengths
+
+    def get_sampler_weights(self, doc_weights=None):
+        """
+        Returns sampling weights of chunks. Every document is drawn with doc_weights (uniform by default) and its chunk
+        is drawn with label2weight, so chunk sampling keeps distribution of document sampling.
+        """
+
+        assert self.chunk_ids is not None, 'Chunk sampling weights require chunk index.'
+
+        if doc_weights is None:
+            doc_weights = np.ones(len(self.indexes))
+        doc_weights = np.asarray(doc_weights, dtype=np.float64)
+        assert len(doc_weights) == len(self.indexes)
 
-        o2t = []
-        t2o = []
+        label_ids = self.chunk_index.chunks['label_id'][self.chunk_ids]
+        label_weights = np.asarray([self.label2weight[self.id2labels[i]] for i in range(len(self.id2labels))])
 
-        tokenized_text = []
-        word_i = 0
-        for word_i, word in enumerate(text, start=start + 1):
-            o2t.append(len(tokenized_text) + history_len)
-            if re.match(r'<.+>', word):
-                continue
+        chunk_weights = label_weights[label_ids]
+        doc_sums = np.bincount(self.chunk_doc_positions, weights=chunk_weights, minlength=len(self.indexes))
 
-            word_tokens = tokenizer.encode(word)
-            for token in word_tokens:
-                t2o.append(word_i)
-                tokenized_text.append(token)
+        weights = doc_weights[self.chunk_doc_positions] * chunk_weights / doc_sums[self.chunk_doc_positions]
 
-        return tokenized_text, o2t, t2o, history_len + len(tokenized_text), word_i
+        return weights / np.sum(weights)
 
-    def _split_doc(self, line):
-        encoded_text, o2t, t2o, _, _ = SplitDataset._drop_tags_and_encode(self.tokenizer, line['document_text'])
+    def _encode_document(self, idx, line):
+        if self.cache is not None:
+            return self.cache[idx]
+
+        return encode_document(self.tokenizer, line['document_text'], sentence_tokenizer=self.sentence_tokenizer)
+
+    def _split_doc(self, line, document):
+        encoded_text, o2t, _ = document.input_ids, document.o2t, document.t2o
         encoded_question = self.tokenizer.encode(line['question_text'])[:self.max_question_len]
 
         class_label, start_position, end_position = RawPreprocessor._get_target(line)
 
         assert start_position <= end_position, 'Before mapping.'
 
-        start_position = o2t[start_position]
-        end_position = o2t[end_position]
+        start_position = int(o2t[start_position])
+        end_position = int(o2t[end_position])
 
         assert start_position <= end_position, 'After mapping.'
 
@@ -281,31 +856,20 @@ class SplitDataset:
 
         document_len = self.max_seq_len - len(encoded_question) - 3  # [CLS], [SEP], [SEP]
 
-        samples = []
-        weights = []
-
-        for doc_start in range(0, len(encoded_text), self.doc_stride):
-            doc_end = doc_start + document_len
-            if not (doc_start <= start_position and end_position <= doc_end):
-                start, end, label = -1, -1, 'unknown'
-            else:
-                start = start_position - doc_start + len(encoded_question) + 2
-                end = end_position - doc_start + len(encoded_question) + 2
-                label = class_label
-
-            weights.append(self.label2weight[label])
-            samples.append((start, end, label, doc_start, doc_end))
-
-            if self.test:
-                break
+        doc_starts, doc_ends = plan_stride_windows(len(encoded_text), document_len, self.doc_stride,
+                                                   first_only=self.test)
+        contains, starts, ends = get_window_targets(doc_starts, doc_ends, start_position, end_position,
+                                                    len(encoded_question) + 2)
+        labels = [class_label if window_flag else 'unknown' for window_flag in contains]
 
-        weights = np.asarray(weights)
+        weights = np.asarray([self.label2weight[label] for label in labels])
         weights = weights / np.sum(weights)
 
-        idx = np.random.choice(np.arange(len(samples)), 1, p=weights)[0]
-        start, end, label, doc_start, doc_end = samples[idx]
+        idx = np.random.choice(np.arange(len(labels)), 1, p=weights)[0]
+        start, end, label = int(starts[idx]), int(ends[idx]), labels[idx]
 
-        chunk = encoded_text[doc_start: doc_end]
+        # only the sampled window is copied
+        chunk = encoded_text[doc_starts[idx]:doc_ends[idx]].tolist()
         input_ids = [self.tokenizer.cls_token_id] + encoded_question + \
                     [self.tokenizer.sep_token_id] + chunk + \
                     [self.tokenizer.sep_token_id]
@@ -319,9 +883,27 @@ class SplitDataset:
                            label_id=self.labels2id[label],
                            example_id=example_id,
                            start_position=start / self.max_seq_len,
-                           end_position=end / self.max_seq_len)
+                           end_position=end / self.max_seq_len,
+                           question_len=len(encoded_question))
+
+    def _truncate_sample(self, sample_ids, start, end, question_len, document_len):
+        if self.truncate and len(sample_ids) > document_len:
+            start_ = start - question_len - 2
+            end_ = end - question_len - 2
+
+            if start_ < document_len and end_ < document_len:
+                sample_ids = sample_ids[:document_len]
+            else:
+                sample_ids = sample_ids[start_:start_ + document_len]
+                start_ = 0
+                end_ = min(end_ - start_, len(sample_ids))
 
-    def _split_doc_by_sentence(self, line):
+                start = start_ + question_len + 2
+                end = end_ + question_len + 2
+
+        return sample_ids, start, end
+
+    def _split_doc_by_sentence(self, line, document):
         text = line['document_text']
         question = line['question_text']
 
@@ -330,116 +912,43 @@ class SplitDataset:
 
         class_label, start_position, end_position = RawPreprocessor._get_target(line)
 
-        sens = self.sentence_tokenizer.tokenize(text)
-
         example_id = line['example_id']
 
-        # sentences encoding
-        t_sens, t_o2t, t_t2o = [], [], []
-        start = -1
-        hystory = 0
-        for sen in sens:
-            sen_, o2t_, t2o_, hystory, start = SplitDataset._drop_tags_and_encode(self.tokenizer, sen,
-                                                                                  history_len=hystory,
-                                                                                  start=start)
-
-            t_sens.append(sen_)
-            t_o2t.append(o2t_)
-            t_t2o.append(t2o_)
-
-        # maping positions into token positions
-        o2t = sum(t_o2t, [])
-        t2o = sum(t_t2o, [])
+        o2t, t2o = document.o2t, document.t2o
 
         assert start_position <= end_position, 'Before mapping.'
 
         o_sp, o_ep = start_position, end_position
 
-        start_position = o2t[start_position]
-        end_position = o2t[end_position]
+        start_position = int(o2t[start_position])
+        end_position = int(o2t[end_position])
 
         assert start_position <= end_position, 'After mapping.'
 
-        # chunk initialization
-        doc_start = 0
-        doc_end = 0
-
-        chunk_sents = []
-        chunk_o2t = []
-        chunk_t2o = []
-
-        samples = []
-        weights = []
-
-        for sen_, o2t_, t2o_ in zip(t_sens, t_o2t, t_t2o):
-            assert doc_end - doc_start >= 0
-
-            if doc_end - doc_start + len(sen_) > document_len:
-                while len(chunk_sents) and (doc_end - doc_start + len(sen_) > document_len):
-                    sample_ids = sum(chunk_sents, [])
-                    if not (doc_start <= start_position and end_position <= doc_end):
-                        start, end, label = -1, -1, 'unknown'
-                    else:
-                        start = start_position - doc_start + len(encoded_question) + 2
-                        end = end_position - doc_start + len(encoded_question) + 2
-                        label = class_label
-
-                    weights.append(self.label2weight[label])
-                    samples.append((sample_ids, start, end, label, len(chunk_sents), doc_start, doc_end))
-
-                    del_sen = chunk_sents.pop(0)
-
-                    chunk_o2t.pop(0)
-                    chunk_t2o.pop(0)
-                    doc_start += len(del_sen)
-
-            doc_end += len(sen_)
-
-            chunk_sents.append(sen_)
-            chunk_o2t.append(o2t_)
-            chunk_t2o.append(t2o_)
-
-        # add tail
-        sample_ids = sum(chunk_sents, [])
-        if not (doc_start <= start_position and end_position <= doc_end):
-            start, end, label = -1, -1, 'unknown'
-        else:
-            start = start_position - doc_start + len(encoded_question) + 2
-            end = end_position - doc_start + len(encoded_question) + 2
-            label = class_label
-
-        weights.append(self.label2weight[label])
-        samples.append((sample_ids, start, end, label, len(chunk_sents), doc_start, doc_end))
+        doc_starts, doc_ends, n_sents = plan_sentence_windows(document.sentence_bounds, document_len)
+        contains, starts, ends = get_window_targets(doc_starts, doc_ends, start_position, end_position,
+                                                    len(encoded_question) + 2)
+        labels = [class_label if window_flag else 'unknown' for window_flag in contains]
 
         # sampling
-        assert len(samples), f'Empty document: {example_id}?'
+        assert len(labels), f'Empty document: {example_id}?'
 
         if self.test:
-            for idx in range(len(samples)):
-                label = samples[idx][3]
+            for idx in range(len(labels)):
+                label = labels[idx]
                 if label == class_label:
                     break
         else:
-            weights = np.asarray(weights)
+            weights = np.asarray([self.label2weight[label] for label in labels])
             weights = weights / np.sum(weights)
 
-            idx = np.random.choice(np.arange(len(samples)), 1, p=weights)[0]
+            idx = np.random.choice(np.arange(len(labels)), 1, p=weights)[0]
 
-        sample_ids, start, end, label, cl, ds, de = samples[idx]
+        ds, de, cl = int(doc_starts[idx]), int(doc_ends[idx]), int(n_sents[idx])
+        sample_ids = document.input_ids[ds:de].tolist()
+        start, end, label = int(starts[idx]), int(ends[idx]), labels[idx]
 
-        if self.truncate and len(sample_ids) > document_len:
-            start_ = start - len(encoded_question) - 2
-            end_ = end - len(encoded_question) - 2
-
-            if start_ < document_len and end_ < document_len:
-                sample_ids = sample_ids[:document_len]
-            else:
-                sample_ids = sample_ids[start_:start_ + document_len]
-                start_ = 0
-                end_ = min(end_ - start_, len(sample_ids))
-
-                start = start_ + len(encoded_question) + 2
-                end = end_ + len(encoded_question) + 2
+        sample_ids, start, end = self._truncate_sample(sample_ids, start, end, len(encoded_question), document_len)
 
         input_ids = [self.tokenizer.cls_token_id] + encoded_question + \
                     [self.tokenizer.sep_token_id] + sample_ids + \
@@ -462,59 +971,178 @@ class SplitDataset:
                            label_id=self.labels2id[label],
                            example_id=example_id,
                            start_position=start / self.max_seq_len,
-                           end_position=end / self.max_seq_len)
+                           end_position=end / self.max_seq_len,
+                           question_len=len(encoded_question))
+
+    def _get_chunk(self, chunk_id):
+        chunk = self.chunk_index[chunk_id]
+        idx = int(chunk['doc_id'])
+
+        # encoded question and example id are read from chunk index, so record of document is not decoded
+        encoded_question = self.chunk_index.get_question(idx).tolist()
+        example_id = self.chunk_index.get_example_id(idx)
+        document_len = self.max_seq_len - len(encoded_question) - 3  # [CLS], [SEP], [SEP]
+
+        # only the selected window of document is read from tokenized cache
+        ds, de = int(chunk['doc_start']), int(chunk['doc_end'])
+        sample_ids = self.cache[idx].input_ids[ds:de].tolist()
+        start, end = int(chunk['start_id']), int(chunk['end_id'])
+
+        if self.split_by_sentence:
+            sample_ids, start, end = self._truncate_sample(sample_ids, start, end, len(encoded_question), document_len)
+
+        input_ids = [self.tokenizer.cls_token_id] + encoded_question + \
+                    [self.tokenizer.sep_token_id] + sample_ids + \
+                    [self.tokenizer.sep_token_id]
+
+        assert len(input_ids) <= self.max_seq_len, f'Chunk length {len(input_ids)} of {example_id} ' \
+                                                   f'is more then limit {self.max_seq_len}.'
+        assert -1 <= start < self.max_seq_len, f'Incorrect start index: {start}.'
+        assert -1 <= end < self.max_seq_len, f'Incorrect start index: {end}.'
+
+        return DatasetItem(input_ids=input_ids,
+                           start_id=start,
+                           end_id=end,
+                           label_id=int(chunk['label_id']),
+                           example_id=example_id,
+                           start_position=start / self.max_seq_len,
+                           end_position=end / self.max_seq_len,
+                           question_len=len(encoded_question))
 
     def __getitem__(self, idx):
-        idx = self.indexes[idx]
+        if self.chunk_ids is not None:
+            return self._get_chunk(int(self.chunk_ids[idx]))
+
+        idx = int(self.indexes[idx])
+
+        return self._get_document_item(idx, self.storage[idx])
+
+    def _get_document_item(self, idx, line):
+        document = self._encode_document(idx, line)
 
-        with open(self.data_dir / f'{idx}.json', 'r') as in_file:
-            line = json.load(in_file)
         if self.split_by_sentence:
-            chunk = self._split_doc_by_sentence(line)
+            chunk = self._split_doc_by_sentence(line, document)
         else:
-            chunk = self._split_doc(line)
+            chunk = self._split_doc(line, document)
 
         return chunk
 
 
-def collate_fun(items, tokenizer, return_items=False):
+def _new_array(shape, fill_value, *, dtype=torch.int64, pin_memory=False, share_memory=False):
+    # numpy array shares memory with tensor, so pinned or shared memory is filled without extra copy
+    tensor = torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+    if share_memory:
+        tensor.share_memory_()
+    array = tensor.numpy()
+    array.fill(fill_value)
+
+    return tensor, array
+
+
+def collate_fun(items, tokenizer, return_items=False, *, pin_memory=False, share_memory=False, pad_multiple=1):
     batch_size = len(items)
-    pad_token_id = tokenizer.pad_token_id
 
-    max_len = max([len(item.input_ids) for item in items])
-    tokens = pad_token_id * np.ones((batch_size, max_len), dtype=np.int64)
+    lengths = np.fromiter((len(item.input_ids) for item in items), dtype=np.int64, count=batch_size)
+    max_len = int(np.max(lengths))
+    max_len = pad_multiple * ((max_len + pad_multiple - 1) // pad_multiple)
+
+    positions = np.arange(max_len)
+    token_mask = positions < lengths[:, np.newaxis]
+
+    tokens_tensor, tokens = _new_array((batch_size, max_len), tokenizer.pad_token_id, pin_memory=pin_memory,
+                                       share_memory=share_memory)
+    tokens[token_mask] = np.fromiter(itertools.chain.from_iterable(item.input_ids for item in items),
+                                     dtype=np.int64, count=int(np.sum(lengths)))
+
+    attention_mask_tensor, attention_mask = _new_array((batch_size, max_len), False, dtype=torch.bool,
+                                                       pin_memory=pin_memory, share_memory=share_memory)
+    attention_mask[...] = token_mask
+
+    token_type_ids_tensor, token_type_ids = _new_array((batch_size, max_len), 0, pin_memory=pin_memory,
+                                                       share_memory=share_memory)
+    if tokenizer.model_name == 'bert':
+        # question is encoded with its own [SEP] unless it was truncated, tokens after the first [SEP] have type 1
+        question_lens = np.fromiter((item.question_len for item in items), dtype=np.int64, count=batch_size)
+        sep_positions = question_lens + (tokens[np.arange(batch_size), question_lens] != tokenizer.sep_token_id)
+        token_type_ids[...] = positions > sep_positions[:, np.newaxis]
+
+    inputs = {'input_ids': tokens_tensor,
+              'attention_mask': attention_mask_tensor,
+              'token_type_ids': token_type_ids_tensor}
+
+    labels = _collate_labels(items)
+
+    if return_items:
+        return [inputs, labels, items]
+
+    return [inputs, labels]
+
+
+def packed_collate_fun(items, tokenizer, max_seq_len, return_items=False, *, pin_memory=False, share_memory=False,
+                       pad_multiple=1):
+    """
+    Packs several items into one row of max_seq_len tokens. Items do not attend to each other and have their own
+    position ids, segments contain row, offset and length of every item, so model outputs are unpacked to items.
+    """
+
+    lengths = np.array([len(item.input_ids) for item in items])
+    rows, offsets, n_rows = plan_packing(lengths, max_seq_len)
+
+    max_len = int(np.max(offsets + lengths))
+    max_len = pad_multiple * ((max_len + pad_multiple - 1) // pad_multiple)
+
+    memory = {'pin_memory': pin_memory, 'share_memory': share_memory}
+
+    tokens_tensor, tokens = _new_array((n_rows, max_len), tokenizer.pad_token_id, **memory)
 
     type_coef = 1 if tokenizer.model_name == 'bert' else 0
-    token_type_ids = type_coef * np.ones((batch_size, max_len), dtype=np.int64)
+    token_type_ids_tensor, token_type_ids = _new_array((n_rows, max_len), type_coef, **memory)
 
-    for i, item in enumerate(items):
+    # roberta positions start after padding index
+    position_offset = tokenizer.pad_token_id + 1 if tokenizer.model_name == 'roberta' else 0
+    position_ids_tensor, position_ids = _new_array((n_rows, max_len), position_offset, **memory)
+
+    segment_ids = -np.ones((n_rows, max_len), dtype=np.int64)
+
+    for i, (item, row_i, offset, length) in enumerate(zip(items, rows, offsets, lengths)):
         row = item.input_ids
 
-        tokens[i, :len(row)] = row
+        tokens[row_i, offset:offset + length] = row
         if type_coef:
-            token_type_ids[i, :len(row)] = [0 if i <= row.index(tokenizer.sep_token_id) else 1 for i in range(len(row))]
+            token_type_ids[row_i, offset:offset + row.index(tokenizer.sep_token_id) + 1] = 0
+        position_ids[row_i, offset:offset + length] += np.arange(length)
+        segment_ids[row_i, offset:offset + length] = i
 
-    attention_mask = tokens > 0
-    inputs = {'input_ids': torch.from_numpy(tokens),
-              'attention_mask': torch.from_numpy(attention_mask),
-              'token_type_ids': torch.from_numpy(token_type_ids)}
+    # block-diagonal mask: tokens attend to tokens of the same item only
+    attention_mask_tensor, attention_mask = _new_array((n_rows, max_len, max_len), False, dtype=torch.bool, **memory)
+    attention_mask[...] = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] >= 0)
 
-    # output labels
-    start_ids = np.array([item.start_id for item in items])
-    end_ids = np.array([item.end_id for item in items])
+    segments_tensor, segments = _new_array((len(items), 3), 0, **memory)
+    segments[...] = np.stack([rows, offsets, lengths], axis=-1)
 
-    start_pos = np.array([item.start_position for item in items])
-    end_pos = np.array([item.end_position for item in items])
+    inputs = {'input_ids': tokens_tensor,
+              'attention_mask': attention_mask_tensor,
+              'token_type_ids': token_type_ids_tensor,
+              'position_ids': position_ids_tensor,
+              'segments': segments_tensor}
 
-    label_ids = [item.label_id for item in items]
-
-    labels = {'start_class': torch.LongTensor(start_ids),
-              'end_class': torch.LongTensor(end_ids),
-              'start_reg': torch.FloatTensor(start_pos),
-              'end_reg': torch.FloatTensor(end_pos),
-              'cls': torch.LongTensor(label_ids)}
+    labels = _collate_labels(items)
 
     if return_items:
         return [inputs, labels, items]
 
     return [inputs, labels]
+
+
+def _collate_labels(items):
+    # arrays are transposed and copied, so every label is a contiguous row
+    targets = np.array([(item.start_id, item.end_id, item.label_id) for item in items], dtype=np.int64).T.copy()
+    positions = np.array([(item.start_position, item.end_position) for item in items], dtype=np.float32).T.copy()
+
+    labels = {'start_class': torch.from_numpy(targets[0]),
+              'end_class': torch.from_numpy(targets[1]),
+              'start_reg': torch.from_numpy(positions[0]),
+              'end_reg': torch.from_numpy(positions[1]),
+              'cls': torch.from_numpy(targets[2])}
+
+    return labels
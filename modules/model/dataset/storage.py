@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import socket
+import tempfile
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+from .codec import get_codec
+
+logger = logging.getLogger(__name__)
+
+
+class ShardWriter(object):
+    def __init__(self, data_dir, shard_id, *, codec='json', buffer_size=16 * 1024 * 1024):
+        self.shard_id = shard_id
+        self.path = Path(data_dir) / ShardedStorage.shard_name(shard_id)
+        self.codec = get_codec(codec)
+
+        self._file = open(self.path, 'wb', buffering=buffer_size)
+        self._offset = 0
+
+    def write(self, record):
+        data = self.codec.encode(record)
+        self._file.write(data)
+
+        entry = (self.shard_id, self._offset, len(data))
+        self._offset += len(data)
+
+        return entry
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardedStorage(object):
+    index_name = 'storage.index.npy'
+    meta_name = 'storage.meta.json'
+    version = 2
+
+    def __init__(self, data_dir):
+        self.data_dir = Path(data_dir)
+
+        with open(self.data_dir / self.meta_name, 'r') as in_file:
+            self.meta = json.load(in_file)
+
+        self.codec = get_codec(self.meta['codec'])
+
+        self._index = None
+        self._shards = {}
+        self._fingerprint = None
+
+    @property
+    def index(self):
+        # index[i] = (shard id, offset, length) of record i
+        if self._index is None:
+            self._index = np.load(self.data_dir / self.index_name, mmap_mode='r')
+
+        return self._index
+
+    @property
+    def fingerprint(self):
+        # derived caches are valid only for the same index of records, it is rewritten by every preprocessing
+        if self._fingerprint is None:
+            hasher = hashlib.sha1()
+            with open(self.data_dir / self.index_name, 'rb') as in_file:
+                for block in iter(lambda: in_file.read(16 * 1024 * 1024), b''):
+                    hasher.update(block)
+            self._fingerprint = hasher.hexdigest()[:16]
+
+        return self._fingerprint
+
+    @staticmethod
+    def shard_name(shard_id):
+        return f'shard_{shard_id:05d}.bin'
+
+    @staticmethod
+    def exists(data_dir):
+        data_dir = Path(data_dir)
+        if not (data_dir / ShardedStorage.index_name).exists() or not (data_dir / ShardedStorage.meta_name).exists():
+            return False
+
+        with open(data_dir / ShardedStorage.meta_name, 'r') as in_file:
+            return json.load(in_file).get('version') == ShardedStorage.version
+
+    @staticmethod
+    def write_index(data_dir, index, *, codec='json'):
+        index_path = Path(data_dir) / ShardedStorage.index_name
+        tmp_path = index_path.with_name(index_path.name + '.tmp')
+
+        with open(tmp_path, 'wb') as out_file:
+            np.save(out_file, np.asarray(index, dtype=np.uint64))
+        os.replace(tmp_path, index_path)
+
+        with open(Path(data_dir) / ShardedStorage.meta_name, 'w') as out_file:
+            json.dump({'version': ShardedStorage.version, 'codec': codec, 'n_records': len(index)}, out_file)
+
+        logger.info(f'Storage index was dumped to {index_path}.')
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            with open(self.data_dir / ShardedStorage.shard_name(shard_id), 'rb') as in_file:
+                self._shards[shard_id] = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._shards[shard_id]
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every process
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_shards'] = {}
+
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_bytes(self, idx):
+        shard_id, offset, length = (int(v) for v in self.index[idx])
+
+        return self._get_shard(shard_id)[offset:offset + length]
+
+    def __getitem__(self, idx):
+        return self.codec.decode(self.read_bytes(idx))
+
+    def read_block(self, idxs):
+        """
+        Reads records with one sequential read per shard: byte range from the first to the last record is read
+        at once, records between them are read and skipped. Records are returned in order of idxs.
+        """
+
+        idxs = np.asarray(idxs, dtype=np.int64)
+        entries = self.index[idxs].astype(np.int64)
+
+        records = [None] * len(idxs)
+        for shard_id in np.unique(entries[:, 0]):
+            positions = np.flatnonzero(entries[:, 0] == shard_id)
+            offsets, lengths = entries[positions, 1], entries[positions, 2]
+
+            start, end = int(np.min(offsets)), int(np.max(offsets + lengths))
+            with open(self.data_dir / ShardedStorage.shard_name(int(shard_id)), 'rb', buffering=0) as in_file:
+                in_file.seek(start)
+                block = in_file.read(end - start)
+
+            for position, offset, length in zip(positions, offsets - start, lengths):
+                records[position] = self.codec.decode(block[offset:offset + length])
+
+        return records
+
+
+def _remove_shared_dir(shared_dir, owner_pid):
+    # forked processes must not remove arrays of their parent
+    if os.getpid() == owner_pid:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists, but it belongs to another user
+        pass
+
+    return True
+
+
+def _remove_stale_dirs(root_dir, prefix):
+    # directories of killed processes are left by finalizers, pid of owner is a part of directory name
+    for shared_dir in Path(root_dir).glob(f'{prefix}*'):
+        pid = shared_dir.name[len(prefix):].split('_', 1)[0]
+        if pid.isdigit() and not _is_alive(int(pid)):
+            shutil.rmtree(shared_dir, ignore_errors=True)
+            logger.info(f'Stale shared arrays {shared_dir} were removed.')
+
+
+class SharedArrays(object):
+    """
+    Read-only arrays which are dumped once to memory mapped files and attached lazily by every process. Only paths
+    are pickled to dataloader workers, so pages of arrays are shared between processes instead of being copied.
+    Files are removed when the arrays are collected in the process which created them, files of killed processes
+    of the same host are removed by the next SharedArrays in root_dir.
+    """
+
+    def __init__(self, arrays, *, root_dir=None):
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items() if array is not None}
+
+        if root_dir is None:
+            root_dir = SharedArrays._get_default_root_dir(sum(array.nbytes for array in arrays.values()))
+        root_dir = Path(root_dir)
+
+        prefix = f'shared_arrays_{socket.gethostname()}_'
+        _remove_stale_dirs(root_dir, prefix)
+
+        self.shared_dir = Path(tempfile.mkdtemp(prefix=f'{prefix}{os.getpid()}_', dir=root_dir))
+        self.names = list(arrays)
+
+        for name in self.names:
+            np.save(self.shared_dir / f'{name}.npy', arrays[name])
+
+        self._arrays = None
+        self._finalizer = weakref.finalize(self, _remove_shared_dir, self.shared_dir, os.getpid())
+
+    @staticmethod
+    def _get_default_root_dir(n_bytes):
+        # node-local directories only: /dev/shm is small in Docker (64 MB by default), so it is used only if arrays
+        # take at most half of its free space
+        if os.path.isdir('/dev/shm') and n_bytes <= shutil.disk_usage('/dev/shm').free // 2:
+            return '/dev/shm'
+
+        return tempfile.gettempdir()
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(self.shared_dir / f'{name}.npy', mmap_mode='r') for name in self.names}
+
+        return self._arrays
+
+    def get(self, name):
+        return self._get_arrays()[name] if name in self.names else None
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every process, files are owned by the process which created them
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        state['_finalizer'] = None
+
+        return state
@@ -0,0 +1,104 @@
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .storage import SharedArrays
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingDataset(IterableDataset):
+    """
+    Streams items of documents of SplitDataset. Documents are read in storage order by blocks of block_size records
+    with one sequential read per block, order of blocks is shuffled in every epoch and items are shuffled through
+    buffer of buffer_size items. Documents of epoch are split evenly between processes and dataloader workers.
+    """
+
+    def __init__(self, dataset, *, block_size=1024, buffer_size=10000, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+
+        assert not dataset.test, 'Streaming dataset is not used in test mode.'
+
+        self.dataset = dataset
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        # documents are sorted by shard and offset, so every block is a sequential byte range of shard
+        doc_ids = np.asarray(dataset.indexes, dtype=np.int64)
+        entries = dataset.storage.index[doc_ids]
+        self.arrays = SharedArrays({'doc_ids': doc_ids[np.lexsort((entries[:, 1], entries[:, 0]))]},
+                                   root_dir=dataset.shared_arrays_dir)
+
+        logger.info(f'Documents are streamed in blocks of {self.block_size} documents, '
+                    f'shuffle buffer size is {self.buffer_size}.')
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # number of items of process, every worker reads the same number of documents
+        return len(self.arrays.get('doc_ids')) // self.num_replicas
+
+    def _get_part(self):
+        worker_info = get_worker_info()
+        n_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+
+        return self.rank * n_workers + worker_id, self.num_replicas * n_workers
+
+    def _get_part_doc_ids(self, part_id, n_parts):
+        doc_ids = self.arrays.get('doc_ids')
+
+        # order of blocks is drawn from seed and epoch, so every worker of every process draws the same order
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        n_blocks = (len(doc_ids) + self.block_size - 1) // self.block_size
+        block_ids = torch.randperm(n_blocks, generator=generator).numpy()
+
+        # shuffled blocks are split into equal parts, so processes have the same number of batches
+        part_size = len(doc_ids) // n_parts
+        part_start, part_end = part_id * part_size, (part_id + 1) * part_size
+
+        block_lengths = np.minimum((block_ids + 1) * self.block_size, len(doc_ids)) - block_ids * self.block_size
+        block_starts = np.cumsum(block_lengths) - block_lengths
+
+        part_doc_ids = []
+        for block_id, block_start, block_len in zip(block_ids, block_starts, block_lengths):
+            start, end = max(part_start - block_start, 0), min(part_end - block_start, block_len)
+            if start < end:
+                part_doc_ids.append(doc_ids[block_id * self.block_size + start:block_id * self.block_size + end])
+
+        return part_doc_ids
+
+    def _iter_items(self, part_doc_ids):
+        for block_doc_ids in part_doc_ids:
+            for idx, line in zip(block_doc_ids, self.dataset.storage.read_block(block_doc_ids)):
+                yield self.dataset._get_document_item(int(idx), line)
+
+    def __iter__(self):
+        part_id, n_parts = self._get_part()
+        random_state = np.random.RandomState([self.seed, self.epoch, part_id])
+
+        buffer = []
+        for item in self._iter_items(self._get_part_doc_ids(part_id, n_parts)):
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+
+            # random item of full buffer is yielded and replaced with the new one
+            buffer_i = random_state.randint(len(buffer))
+            buffer[buffer_i], item = item, buffer[buffer_i]
+
+            yield item
+
+        random_state.shuffle(buffer)
+        yield from buffer
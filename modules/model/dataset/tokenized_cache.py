@@ -0,0 +1,227 @@
+import hashlib
+import json
+import logging
+import multiprocessing as mp
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from .encoding import EncodedDocument, encode_document, load_sentence_tokenizer
+
+logger = logging.getLogger(__name__)
+
+_FINGERPRINT_PROBE = 'Tokenizer FINGERPRINT: naïve café, Straße 東京 <P> 1,234.5 ##ing'
+
+# state of preprocessing workers, it is set once by pool initializer
+_worker_state = {}
+
+
+def _without_dropout(tokenizer):
+    # BPE dropout makes encoding random, documents are cached and fingerprinted by deterministic tokenizer
+    init_args = getattr(tokenizer, '_init_args', None)
+    if init_args is None or init_args.get('dropout') is None:
+        return tokenizer
+
+    return type(tokenizer)(**{**init_args, 'dropout': None})
+
+
+def tokenizer_fingerprint(tokenizer):
+    hasher = hashlib.sha1()
+
+    hasher.update(str(getattr(tokenizer, 'model_name', type(tokenizer).__name__)).encode('utf-8'))
+    hasher.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode('utf-8'))
+    # probe covers normalization options (lowercase, accents, chinese chars) which are not a part of the vocab
+    hasher.update(json.dumps(list(tokenizer.encode(_FINGERPRINT_PROBE))).encode('utf-8'))
+
+    return hasher.hexdigest()[:16]
+
+
+class TokenizedCache(object):
+    arrays = ('input_ids', 'o2t', 't2o', 'sentence_bounds')
+    index_name = 'index.npy'
+    meta_name = 'meta.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+        with open(self.cache_dir / self.meta_name, 'r') as in_file:
+            self.meta = json.load(in_file)
+
+        self.split_by_sentence = self.meta['split_by_sentence']
+
+        self._index = None
+        self._arrays = None
+
+    @property
+    def index(self):
+        # index[i] = offsets of document i in input_ids (t2o), o2t and sentence_bounds arrays
+        if self._index is None:
+            self._index = np.load(self.cache_dir / self.index_name, mmap_mode='r')
+
+        return self._index
+
+    @staticmethod
+    def get_cache_dir(data_dir, tokenizer, *, split_by_sentence=False):
+        tokenizer = _without_dropout(tokenizer)
+        mode = 'sentence' if split_by_sentence else 'word'
+
+        return Path(data_dir) / f'tokenized_{tokenizer_fingerprint(tokenizer)}_{mode}'
+
+    @classmethod
+    def load_or_build(cls, data_dir, storage, tokenizer, *, split_by_sentence=False, n_jobs=1):
+        tokenizer = _without_dropout(tokenizer)
+        cache_dir = TokenizedCache.get_cache_dir(data_dir, tokenizer, split_by_sentence=split_by_sentence)
+
+        if TokenizedCache._is_valid(cache_dir, storage):
+            logger.info(f'Tokenized documents were loaded from {cache_dir}.')
+        else:
+            cls.build(storage, tokenizer, cache_dir, split_by_sentence=split_by_sentence, n_jobs=n_jobs)
+
+        return cls(cache_dir)
+
+    @staticmethod
+    def _is_valid(cache_dir, storage):
+        meta_path = Path(cache_dir) / TokenizedCache.meta_name
+        if not meta_path.exists():
+            return False
+
+        with open(meta_path, 'r') as in_file:
+            meta = json.load(in_file)
+
+        # documents are cached by position, so cache is stale if storage was rewritten
+        return meta.get('storage_fingerprint') == storage.fingerprint and meta.get('n_docs') == len(storage)
+
+    @staticmethod
+    def _init_worker(storage, tokenizer, split_by_sentence, cache_dir):
+        _worker_state['storage'] = storage
+        _worker_state['tokenizer'] = tokenizer
+        _worker_state['sentence_tokenizer'] = load_sentence_tokenizer() if split_by_sentence else None
+        _worker_state['cache_dir'] = cache_dir
+
+    @staticmethod
+    def _part_path(cache_dir, shard_id, name):
+        return cache_dir / f'part_{shard_id:05d}.{name}.bin'
+
+    @staticmethod
+    def _encode_shard(args):
+        shard_id, start, end = args
+
+        storage = _worker_state['storage']
+        cache_dir = _worker_state['cache_dir']
+
+        lengths = np.zeros((end - start, 3), dtype=np.int64)
+        out_files = {name: open(TokenizedCache._part_path(cache_dir, shard_id, name), 'wb')
+                     for name in TokenizedCache.arrays}
+
+        try:
+            for doc_i in range(start, end):
+                document = encode_document(_worker_state['tokenizer'], storage[doc_i]['document_text'],
+                                           sentence_tokenizer=_worker_state['sentence_tokenizer'])
+                sentence_bounds = document.sentence_bounds if document.sentence_bounds is not None \
+                    else np.zeros(0, dtype=np.int32)
+
+                for name, array in zip(TokenizedCache.arrays,
+                                       (document.input_ids, document.o2t, document.t2o, sentence_bounds)):
+                    out_files[name].write(array.astype(np.int32).tobytes())
+
+                lengths[doc_i - start] = (len(document.input_ids), len(document.o2t), len(sentence_bounds))
+        finally:
+            for out_file in out_files.values():
+                out_file.close()
+
+        return shard_id, lengths
+
+    @staticmethod
+    def build(storage, tokenizer, cache_dir, *, split_by_sentence=False, n_jobs=1, shard_size=1024):
+        cache_dir = Path(cache_dir)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+
+        n_docs = len(storage)
+        shards = [(shard_id, start, min(start + shard_size, n_docs))
+                  for shard_id, start in enumerate(range(0, n_docs, shard_size))]
+
+        logger.info(f'Documents will be tokenized into {cache_dir} by {max(n_jobs, 1)} processes.')
+
+        lengths = [None] * len(shards)
+        tqdm_data = tqdm(total=n_docs, desc='Tokenizing documents')
+
+        init_args = (storage, tokenizer, split_by_sentence, cache_dir)
+        if n_jobs <= 1:
+            TokenizedCache._init_worker(*init_args)
+            results = map(TokenizedCache._encode_shard, shards)
+            pool = None
+        else:
+            # initializer arguments are inherited by forked workers, so tokenizer is not pickled
+            pool = mp.Pool(n_jobs, initializer=TokenizedCache._init_worker, initargs=init_args)
+            results = pool.imap_unordered(TokenizedCache._encode_shard, shards)
+
+        try:
+            for shard_id, shard_lengths in results:
+                lengths[shard_id] = shard_lengths
+                tqdm_data.update(len(shard_lengths))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _worker_state.clear()
+            tqdm_data.close()
+
+        # merge parts in document order
+        for name in TokenizedCache.arrays:
+            with open(cache_dir / f'{name}.bin', 'wb') as out_file:
+                for shard_id, _, _ in shards:
+                    part_path = TokenizedCache._part_path(cache_dir, shard_id, name)
+                    with open(part_path, 'rb') as in_file:
+                        shutil.copyfileobj(in_file, out_file, 16 * 1024 * 1024)
+                    os.remove(part_path)
+
+        lengths = np.concatenate(lengths, axis=0) if lengths else np.zeros((0, 3), dtype=np.int64)
+        index = np.zeros((n_docs + 1, 3), dtype=np.int64)
+        np.cumsum(lengths, axis=0, out=index[1:])
+        np.save(cache_dir / TokenizedCache.index_name, index)
+
+        # meta file is written last and marks the cache as complete
+        with open(cache_dir / TokenizedCache.meta_name, 'w') as out_file:
+            json.dump({'fingerprint': tokenizer_fingerprint(tokenizer),
+                       'split_by_sentence': split_by_sentence,
+                       'storage_fingerprint': storage.fingerprint,
+                       'n_docs': n_docs,
+                       'n_tokens': int(index[-1, 0])}, out_file)
+
+        logger.info(f'{n_docs} documents ({index[-1, 0]} tokens) were tokenized into {cache_dir}.')
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = {}
+            for name in TokenizedCache.arrays:
+                path = self.cache_dir / f'{name}.bin'
+                self._arrays[name] = np.asarray(np.memmap(path, dtype=np.int32, mode='r')) \
+                    if os.path.getsize(path) else np.zeros(0, dtype=np.int32)
+
+        return self._arrays
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every process
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_arrays'] = None
+
+        return state
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, idx):
+        arrays = self._get_arrays()
+
+        (t_start, o_start, s_start), (t_end, o_end, s_end) = self.index[idx], self.index[idx + 1]
+
+        return EncodedDocument(input_ids=arrays['input_ids'][t_start:t_end],
+                               o2t=arrays['o2t'][o_start:o_end],
+                               t2o=arrays['t2o'][t_start:t_end],
+                               sentence_bounds=arrays['sentence_bounds'][s_start:s_end]
+                               if self.split_by_sentence else None)
@@ -1,13 +1,14 @@
-import json
 import logging
-import re
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List
 
-import nltk
+import numpy as np
 
+from .chunking import get_window_targets, plan_sentence_windows, plan_stride_windows
+from .encoding import encode_document, load_sentence_tokenizer
 from .split_dataset import RawPreprocessor
+from .storage import ShardedStorage
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +29,7 @@ class ChunkItem(object):
 
     question_len: int
 
-    t2o: List[int]
+    t2o: np.ndarray
 
     chunk_start: int
     chunk_end: int
@@ -46,10 +47,12 @@ class ChunkDataset:
                  doc_stride=128,
                  test=False,
                  split_by_sentence=False,
-                 truncate=False):
+                 truncate=False,
+                 cache=None):
         self.data_dir = data_dir
         self.tokenizer = tokenizer
         self.indexes = indexes
+        self.cache = cache
 
         self.max_seq_len = max_seq_len
         self.max_question_len = max_question_len
@@ -61,57 +64,41 @@ class ChunkDataset:
         if isinstance(self.data_dir, str):
             self.data_dir = Path(self.data_dir)
 
+        self.storage = ShardedStorage(self.data_dir)
+
         self.test = test
         self.truncate = truncate
 
         self.split_by_sentence = split_by_sentence
         if self.split_by_sentence:
             logger.info(f'Documents will be split by sentence.')
-            try:
-                self.sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-            except Exception as e:
-                logger.warning('Data for sentence tokenizer will be downloaded. To prevent it in future, '
-                               'download the required package in your env with: '
-                               '\n\t import nltk \n\t nltk.download("punkt")')
 
-                nltk.download('punkt')
+        if self.cache is not None:
+            assert self.cache.split_by_sentence == self.split_by_sentence, \
+                'Tokenized cache was built for another splitting mode.'
+            logger.info(f'Tokenized documents are read from {self.cache.cache_dir}.')
 
-                self.sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+        self.sentence_tokenizer = load_sentence_tokenizer() if self.split_by_sentence and self.cache is None else None
 
     def __len__(self):
         return len(self.indexes)
 
-    @staticmethod
-    def _drop_tags_and_encode(tokenizer, text, *, history_len=0, start=-1):
-        text = text.split()
-
-        o2t = []
-        t2o = []
-
-        tokenized_text = []
-        word_i = 0
-        for word_i, word in enumerate(text, start=start + 1):
-            o2t.append(len(tokenized_text) + history_len)
-            if re.match(r'<.+>', word):
-                continue
+    def _encode_document(self, idx, line):
+        if self.cache is not None:
+            return self.cache[idx]
 
-            word_tokens = tokenizer.encode(word)
-            for token in word_tokens:
-                t2o.append(word_i)
-                tokenized_text.append(token)
+        return encode_document(self.tokenizer, line['document_text'], sentence_tokenizer=self.sentence_tokenizer)
 
-        return tokenized_text, o2t, t2o, history_len + len(tokenized_text), word_i
-
-    def _split_doc(self, line):
-        encoded_text, o2t, t2o, _, _ = ChunkDataset._drop_tags_and_encode(self.tokenizer, line['document_text'])
+    def _split_doc(self, line, document):
+        encoded_text, o2t, t2o = document.input_ids, document.o2t, document.t2o
         encoded_question = self.tokenizer.encode(line['question_text'])[:self.max_question_len]
 
         class_label, start_position, end_position = RawPreprocessor._get_target(line)
 
         assert start_position <= end_position, 'Before mapping.'
 
-        start_position = o2t[start_position]
-        end_position = o2t[end_position]
+        start_position = int(o2t[start_position])
+        end_position = int(o2t[end_position])
 
         assert start_position <= end_position, 'After mapping.'
 
@@ -119,28 +106,19 @@ class ChunkDataset:
 
         document_len = self.max_seq_len - len(encoded_question) - 3  # [CLS], [SEP], [SEP]
 
-        samples = []
-
-        for doc_start in range(0, len(encoded_text), self.doc_stride):
-            doc_end = doc_start + document_len
-            if not (doc_start <= start_position and end_position <= doc_end):
-                start, end, label = -1, -1, 'unknown'
-            else:
-                start = start_position - doc_start + len(encoded_question) + 2
-                end = end_position - doc_start + len(encoded_question) + 2
-                label = class_label
-
-            samples.append((start, end, label, doc_start, doc_end))
+        doc_starts, doc_ends = plan_stride_windows(len(encoded_text), document_len, self.doc_stride,
+                                                   first_only=self.test)
+        contains, starts, ends = get_window_targets(doc_starts, doc_ends, start_position, end_position,
+                                                    len(encoded_question) + 2)
+        labels = [class_label if window_flag else 'unknown' for window_flag in contains]
 
-            if self.test:
-                break
+        # document is converted to list once, so chunks are copied by list slicing
+        text_ids = encoded_text.tolist()
 
         chunks = []
-        for sample in samples:
-
-            start, end, label, doc_start, doc_end = sample
-
-            chunk = encoded_text[doc_start: doc_end]
+        for start, end, label, doc_start, doc_end in zip(starts.tolist(), ends.tolist(), labels,
+                                                         doc_starts.tolist(), doc_ends.tolist()):
+            chunk = text_ids[doc_start: doc_end]
             input_ids = [self.tokenizer.cls_token_id] + encoded_question + \
                         [self.tokenizer.sep_token_id] + chunk + \
                         [self.tokenizer.sep_token_id]
@@ -167,7 +145,7 @@ class ChunkDataset:
 
         return chunks
 
-    def _split_doc_by_sentence(self, line):
+    def _split_doc_by_sentence(self, line, document):
         text = line['document_text']
         question = line['question_text']
 
@@ -176,83 +154,34 @@ class ChunkDataset:
 
         class_label, start_position, end_position = RawPreprocessor._get_target(line)
 
-        sens = self.sentence_tokenizer.tokenize(text)
-
         example_id = line['example_id']
 
-        # sentences encoding
-        t_sens, t_o2t, t_t2o = [], [], []
-        start = -1
-        hystory = 0
-        for sen in sens:
-            sen_, o2t_, t2o_, hystory, start = ChunkDataset._drop_tags_and_encode(self.tokenizer, sen,
-                                                                                  history_len=hystory,
-                                                                                  start=start)
-
-            t_sens.append(sen_)
-            t_o2t.append(o2t_)
-            t_t2o.append(t2o_)
-
-        # maping positions into token positions
-        o2t = sum(t_o2t, [])
-        t2o = sum(t_t2o, [])
+        o2t, t2o = document.o2t, document.t2o
 
         assert start_position <= end_position, 'Before mapping.'
 
         o_sp, o_ep = start_position, end_position
 
-        start_position = o2t[start_position]
-        end_position = o2t[end_position]
+        start_position = int(o2t[start_position])
+        end_position = int(o2t[end_position])
 
         assert start_position <= end_position, 'After mapping.'
 
-        # chunk initialization
-        doc_start = 0
-        doc_end = 0
-
-        chunk_sents = []
-        chunk_o2t = []
-        chunk_t2o = []
-
-        samples = []
-
-        for sen_, o2t_, t2o_ in zip(t_sens, t_o2t, t_t2o):
-            assert doc_end - doc_start >= 0
-
-            if doc_end - doc_start + len(sen_) > document_len:
-                while len(chunk_sents) and (doc_end - doc_start + len(sen_) > document_len):
-                    sample_ids = sum(chunk_sents, [])
-                    if not (doc_start <= start_position and end_position <= doc_end):
-                        start, end, label = -1, -1, 'unknown'
-                    else:
-                        start = start_position - doc_start + len(encoded_question) + 2
-                        end = end_position - doc_start + len(encoded_question) + 2
-                        label = class_label
+        doc_starts, doc_ends, n_sents = plan_sentence_windows(document.sentence_bounds, document_len)
+        contains, starts, ends = get_window_targets(doc_starts, doc_ends, start_position, end_position,
+                                                    len(encoded_question) + 2)
 
-                    samples.append((sample_ids, start, end, label, len(chunk_sents), doc_start, doc_end))
+        labels = [class_label if window_flag else 'unknown' for window_flag in contains]
 
-                    del_sen = chunk_sents.pop(0)
+        # document is converted to list once, so chunks are copied by list slicing
+        input_ids = document.input_ids.tolist()
 
-                    chunk_o2t.pop(0)
-                    chunk_t2o.pop(0)
-                    doc_start += len(del_sen)
+        samples = [(input_ids[ds:de], start, end, label, cl, ds, de)
+                   for ds, de, cl, start, end, label in zip(doc_starts.tolist(), doc_ends.tolist(), n_sents.tolist(),
+                                                            starts.tolist(), ends.tolist(), labels)]
 
-            doc_end += len(sen_)
-
-            chunk_sents.append(sen_)
-            chunk_o2t.append(o2t_)
-            chunk_t2o.append(t2o_)
-
-        # add tail
-        sample_ids = sum(chunk_sents, [])
-        if not (doc_start <= start_position and end_position <= doc_end):
-            start, end, label = -1, -1, 'unknown'
-        else:
-            start = start_position - doc_start + len(encoded_question) + 2
-            end = end_position - doc_start + len(encoded_question) + 2
-            label = class_label
-
-        samples.append((sample_ids, start, end, label, len(chunk_sents), doc_start, doc_end))
+        # bounds of the last window
+        doc_start, doc_end = int(doc_starts[-1]), int(doc_ends[-1])
 
         chunks = []
         for sample in samples:
@@ -309,11 +238,12 @@ class ChunkDataset:
     def __getitem__(self, idx):
         idx = self.indexes[idx]
 
-        with open(self.data_dir / f'{idx}.json', 'r') as in_file:
-            line = json.load(in_file)
+        line = self.storage[idx]
+        document = self._encode_document(idx, line)
+
         if self.split_by_sentence:
-            chunks = self._split_doc_by_sentence(line)
+            chunks = self._split_doc_by_sentence(line, document)
         else:
-            chunks = self._split_doc(line)
+            chunks = self._split_doc(line, document)
 
         return chunks
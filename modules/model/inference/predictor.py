@@ -26,6 +26,7 @@ class Predictor:
                  n_jobs=16,
                  collate_fun=None,
                  buffer_size=4096,
+                 collate_in_workers=False,
                  limit=None):
         self.model = model
         self.device = device
@@ -40,6 +41,7 @@ class Predictor:
         self.n_jobs = n_jobs
         self.collate_fun = collate_fun
         self.buffer_size = buffer_size
+        self.collate_in_workers = collate_in_workers
 
         self.limit = limit
 
@@ -97,6 +99,7 @@ class Predictor:
                                        n_jobs=self.n_jobs,
                                        collate_fun=self.collate_fun,
                                        buffer_size=self.buffer_size,
+                                       collate_in_workers=self.collate_in_workers,
                                        shuffle=True)
 
         if save_dump:
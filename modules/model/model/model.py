@@ -1,5 +1,6 @@
 import logging
 
+import torch
 import torch.nn as nn
 from transformers import BertModel, RobertaModel
 
@@ -40,7 +41,21 @@ class BertForQuestionAnswering(nn.Module):
         self.reg_end = nn.Sequential(nn.Linear(config.hidden_size, 1),
                                      nn.Sigmoid())
 
-    def forward(self, input_ids, attention_mask=None, token_type_ids=None, position_ids=None, head_mask=None):
+    def _unpack_segments(self, sequence_output, segments):
+        # packed rows are split into segments, so outputs have the same layout as outputs of not packed batch
+        rows, offsets, lengths = segments.unbind(-1)
+
+        positions = torch.arange(int(lengths.max()), device=sequence_output.device)
+        segment_mask = positions.unsqueeze(0) < lengths.unsqueeze(-1)
+        positions = torch.clamp(offsets.unsqueeze(-1) + positions.unsqueeze(0), max=sequence_output.size(1) - 1)
+
+        sequence_output = sequence_output[rows.unsqueeze(-1), positions]
+        pooled_output = self.transformer.pooler(sequence_output)
+
+        return sequence_output, pooled_output, segment_mask
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, position_ids=None, head_mask=None,
+                segments=None):
         outputs = self.transformer(input_ids,
                                    attention_mask=attention_mask,
                                    token_type_ids=token_type_ids,
@@ -50,6 +65,10 @@ class BertForQuestionAnswering(nn.Module):
         sequence_output = outputs[0]
         pooled_output = outputs[1]
 
+        segment_mask = None
+        if segments is not None:
+            sequence_output, pooled_output, segment_mask = self._unpack_segments(sequence_output, segments)
+
         # predict start & end position
         position_logits = self.position_outputs(sequence_output)
         start_logits, end_logits = position_logits.split(1, dim=-1)
@@ -57,6 +76,11 @@ class BertForQuestionAnswering(nn.Module):
         start_logits = start_logits.squeeze(-1)
         end_logits = end_logits.squeeze(-1)
 
+        if segment_mask is not None:
+            # positions out of segment belong to other items of the row
+            start_logits = start_logits.masked_fill(~segment_mask, -1e4)
+            end_logits = end_logits.masked_fill(~segment_mask, -1e4)
+
         # classification
         classifier_logits = self.classifier(pooled_output)
 
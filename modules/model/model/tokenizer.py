@@ -1,18 +1,44 @@
+import itertools
 import logging
+from collections import OrderedDict
 
+import numpy as np
 from tokenizers import BertWordPieceTokenizer, ByteLevelBPETokenizer
 
 logger = logging.getLogger(__name__)
 
 
 class Tokenizer:
+    _special_probe = 'a'
+
     def __init__(self, model_name, vocab_file, *,
                  merges_file=None,
                  lowercase=True,
                  handle_chinese_chars=False,
-                 dropout=None):
+                 dropout=None,
+                 cache_size=0):
+
+        # tokenizer from tokenizers is not picklable, so it is created again from these arguments after unpickling
+        self._init_args = {'model_name': model_name,
+                           'vocab_file': vocab_file,
+                           'merges_file': merges_file,
+                           'lowercase': lowercase,
+                           'handle_chinese_chars': handle_chinese_chars,
+                           'dropout': dropout,
+                           'cache_size': cache_size}
 
         self.model_name = model_name
+        self._word_special_ids = None
+
+        if cache_size and dropout is not None and model_name != 'bert':
+            logger.warning('Encoding cache is disabled, because BPE dropout makes encoding random.')
+            cache_size = 0
+
+        # LRU cache of word encodings, it is not shared between processes
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
 
         if model_name == 'bert':
             self._pad_token = '[PAD]'
@@ -51,30 +77,173 @@ class Tokenizer:
         else:
             raise NotImplementedError(f'Tokenizer initialization for model {model_name} is not implemented.')
 
+        # ids of special tokens are looked up once, they are read for every batch
+        self._special_ids = {token: self.tokenizer.token_to_id(token)
+                             for token in (self._pad_token, self._sep_token, self._cls_token, self._unk_token)}
+
+    def __getstate__(self):
+        # encoding cache is not pickled, every process fills its own cache
+        return dict(self._init_args)
+
+    def __setstate__(self, state):
+        model_name = state.pop('model_name')
+        vocab_file = state.pop('vocab_file')
+
+        self.__init__(model_name, vocab_file, **state)
+
     def __len__(self):
         return self.tokenizer._tokenizer.get_vocab_size()
 
+    def get_vocab(self):
+        return self.tokenizer.get_vocab()
+
     def encode(self, string):
-        return self.tokenizer.encode(string).ids
+        if not self.cache_size:
+            return self.tokenizer.encode(string).ids
+
+        ids = self._cache.get(string)
+        if ids is None:
+            self.cache_misses += 1
+            ids = tuple(self.tokenizer.encode(string).ids)
+            self._cache_put(string, ids)
+        else:
+            self.cache_hits += 1
+            self._cache.move_to_end(string)
+
+        return list(ids)
+
+    def _cache_put(self, string, ids):
+        self._cache[string] = ids
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def cache_info(self):
+        n_calls = self.cache_hits + self.cache_misses
+
+        return {'size': len(self._cache),
+                'capacity': self.cache_size,
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_rate': self.cache_hits / n_calls if n_calls else 0}
+
+    def clear_cache(self):
+        self._cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def prewarm_cache(self, words):
+        """
+        Fills encoding cache with the most frequent words. Words are sorted by frequency in descending order.
+        """
+
+        if not self.cache_size:
+            return
+
+        words = list(words)[:self.cache_size]
+        ids, lengths = self._encode_words(words)
+
+        # the most frequent words are the most recently used ones
+        word_ends = np.cumsum(lengths)
+        for word, start, end in reversed(list(zip(words, word_ends - lengths, word_ends))):
+            if word in self._cache:
+                self._cache.move_to_end(word)
+            else:
+                self._cache_put(word, tuple(ids[start:end].tolist()))
+
+        logger.info(f'Encoding cache was prewarmed with {len(self._cache)} words.')
+
+    def _get_word_special_ids(self):
+        # special tokens which are added by post processor before and after every encoded string
+        if self._word_special_ids is None:
+            ids = self.tokenizer.encode(self._special_probe).ids
+            probe_ids = self.tokenizer.encode(self._special_probe, add_special_tokens=False).ids
+
+            start = next(i for i in range(len(ids) - len(probe_ids) + 1) if ids[i:i + len(probe_ids)] == probe_ids)
+            self._word_special_ids = (ids[:start], ids[start + len(probe_ids):])
+
+        return self._word_special_ids
+
+    def encode_words(self, words):
+        """
+        Encodes words by one call of tokenizer. Output is the same as concatenation of encode(word) for every word.
+        Returns token ids and number of tokens of every word.
+        """
+
+        if not self.cache_size:
+            return self._encode_words(words)
+
+        encoded_words = [self._cache.get(word) for word in words]
+
+        # words which are not cached are encoded by one call
+        missed_words = list(OrderedDict.fromkeys(word for word, word_ids in zip(words, encoded_words)
+                                                 if word_ids is None))
+        self.cache_misses += len(missed_words)
+        self.cache_hits += len(words) - len(missed_words)
+
+        if missed_words:
+            ids, lengths = self._encode_words(missed_words)
+            word_ends = np.cumsum(lengths)
+            missed_words = {word: tuple(ids[start:end].tolist())
+                            for word, start, end in zip(missed_words, word_ends - lengths, word_ends)}
+
+            encoded_words = [missed_words[word] if word_ids is None else word_ids
+                             for word, word_ids in zip(words, encoded_words)]
+
+        for word, word_ids in zip(words, encoded_words):
+            if word in self._cache:
+                self._cache.move_to_end(word)
+            else:
+                self._cache_put(word, word_ids)
+
+        lengths = np.fromiter((len(ids) for ids in encoded_words), dtype=np.int64, count=len(encoded_words))
+
+        return np.fromiter(itertools.chain.from_iterable(encoded_words), dtype=np.int32, count=int(lengths.sum())), \
+            lengths
+
+    def _encode_words(self, words):
+        if not words:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+        encoding = self.tokenizer.encode(words, is_pretokenized=True, add_special_tokens=False)
+        word_ids = np.asarray(encoding.word_ids, dtype=np.int64)
+        piece_ids = np.asarray(encoding.ids, dtype=np.int32)
+
+        prefix_ids, suffix_ids = self._get_word_special_ids()
+        n_special = len(prefix_ids) + len(suffix_ids)
+
+        lengths = np.bincount(word_ids, minlength=len(words)) + n_special
+        if not n_special:
+            return piece_ids, lengths
+
+        word_starts = np.cumsum(lengths) - lengths
+
+        ids = np.empty(int(lengths.sum()), dtype=np.int32)
+        ids[np.arange(len(piece_ids)) + word_ids * n_special + len(prefix_ids)] = piece_ids
+        for i, token_id in enumerate(prefix_ids):
+            ids[word_starts + i] = token_id
+        for i, token_id in enumerate(suffix_ids):
+            ids[word_starts + lengths - len(suffix_ids) + i] = token_id
+
+        return ids, lengths
 
     def decode(self, ids, *, skip_special_tokens=True):
         return self.tokenizer.decode(ids, skip_special_tokens=skip_special_tokens).replace(' ##', '')
 
     @property
     def pad_token_id(self):
-        return self.tokenizer.token_to_id(self._pad_token)
+        return self._special_ids[self._pad_token]
 
     @property
     def sep_token_id(self):
-        return self.tokenizer.token_to_id(self._sep_token)
+        return self._special_ids[self._sep_token]
 
     @property
     def cls_token_id(self):
-        return self.tokenizer.token_to_id(self._cls_token)
+        return self._special_ids[self._cls_token]
 
     @property
     def unk_token_id(self):
-        return self.tokenizer.token_to_id(self._unk_token)
+        return self._special_ids[self._unk_token]
 
     @property
     def pad_token(self):
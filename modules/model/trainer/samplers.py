@@ -0,0 +1,192 @@
+import itertools
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Groups indexes of sampler into batches of samples with similar length. Sampler indexes are read by buckets of
+    bucket_size batches, bucket is sorted by length and split into batches which are yielded in random order.
+    """
+
+    def __init__(self, sampler, lengths, batch_size, *, drop_last=False, bucket_size=100, seed=0):
+        self.sampler = sampler
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+        self.seed = seed
+        self.epoch = 0
+
+        self.padding_ratio = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def _iter_buckets(self):
+        bucket = []
+        for idx in self.sampler:
+            bucket.append(idx)
+            if len(bucket) == self.batch_size * self.bucket_size:
+                yield np.asarray(bucket, dtype=np.int64)
+                bucket = []
+
+        if bucket:
+            yield np.asarray(bucket, dtype=np.int64)
+
+    def _split_bucket(self, bucket):
+        batches = [bucket[start:start + self.batch_size] for start in range(0, len(bucket), self.batch_size)]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        return batches
+
+    def _get_padding(self, batches):
+        lengths = [self.lengths[batch] for batch in batches]
+
+        return sum(len(batch_lengths) * np.max(batch_lengths) for batch_lengths in lengths), \
+            sum(np.sum(batch_lengths) for batch_lengths in lengths)
+
+    def __iter__(self):
+        n_batch_tokens, n_tokens = 0, 0
+        n_unsorted_batch_tokens, n_unsorted_tokens = 0, 0
+
+        # order of batches is drawn from seed and epoch, so it is reproduced after resuming
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        for bucket in self._iter_buckets():
+            # stable sort keeps random order of samples with equal length
+            batches = self._split_bucket(bucket[np.argsort(self.lengths[bucket], kind='stable')])
+            if not batches:
+                continue
+
+            bucket_batch_tokens, bucket_tokens = self._get_padding(batches)
+            n_batch_tokens += bucket_batch_tokens
+            n_tokens += bucket_tokens
+
+            unsorted_batch_tokens, unsorted_tokens = self._get_padding(self._split_bucket(bucket))
+            n_unsorted_batch_tokens += unsorted_batch_tokens
+            n_unsorted_tokens += unsorted_tokens
+
+            for batch_i in torch.randperm(len(batches), generator=generator).tolist():
+                yield batches[batch_i].tolist()
+
+        if n_batch_tokens:
+            self.padding_ratio = 1 - n_tokens / n_batch_tokens
+            logger.info(f'Padding ratio of epoch: {self.padding_ratio:.3f} '
+                        f'(without bucketing: {1 - n_unsorted_tokens / n_unsorted_batch_tokens:.3f}).')
+
+
+class DistributedWeightedSampler(Sampler):
+    """
+    Draws weighted sample with replacement and splits it between processes. Every process draws the same sample from
+    seed and epoch, so samples of processes do not intersect and follow the same distribution as WeightedRandomSampler.
+    """
+
+    def __init__(self, weights, num_samples, *, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+
+        # cumulative weights are computed once and reused in every epoch. Sample is drawn by inversion of
+        # cumulative distribution, torch.multinomial does not support more than 2^24 categories
+        self.cum_weights = np.cumsum(np.asarray(weights, dtype=np.float64))
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self.num_samples = (num_samples + num_replicas - 1) // num_replicas
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        random_state = np.random.RandomState(self.seed + self.epoch)
+        values = random_state.random_sample(self.total_size)[self.rank:self.total_size:self.num_replicas]
+
+        indexes = np.searchsorted(self.cum_weights, values * self.cum_weights[-1], side='right')
+        indexes = np.minimum(indexes, len(self.cum_weights) - 1)
+
+        return iter(indexes.tolist())
+
+
+class DistributedRandomSampler(Sampler):
+    """
+    Splits random permutation of dataset between processes. Permutation is drawn from seed and epoch, so it is
+    reproduced after resuming. Permutation is extended by its first indexes to be evenly divisible between processes.
+    """
+
+    def __init__(self, data_source, *, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+
+        self.data_len = len(data_source)
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self.num_samples = (self.data_len + num_replicas - 1) // num_replicas
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        indexes = torch.randperm(self.data_len, generator=generator).tolist()
+        indexes += indexes[:self.total_size - len(indexes)]
+
+        return iter(indexes[self.rank:self.total_size:self.num_replicas])
+
+
+class ResumableBatchSampler(Sampler):
+    """
+    Skips batches of epoch which were consumed before checkpoint, skip_batches is set before every epoch.
+    Only indexes of skipped batches are drawn, samples are not loaded.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch):
+        for sampler in (self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.batch_sampler) - self.skip_batches
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.skip_batches, None)
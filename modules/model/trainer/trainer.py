@@ -1,19 +1,24 @@
 import os
+import random
 import shutil
 from dataclasses import dataclass
 from typing import Any, Optional
 import time
 import functools
+import itertools
 
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, RandomSampler, WeightedRandomSampler, DistributedSampler
+from torch.utils.data import DataLoader, BatchSampler, IterableDataset
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm
 from transformers import get_linear_schedule_with_warmup
 from .utils import apex
 
 from .callback import TestCallback
+from .samplers import BucketBatchSampler, DistributedRandomSampler, DistributedWeightedSampler, \
+    ResumableBatchSampler
 from .meters import *
 
 
@@ -69,8 +74,11 @@ class Trainer:
     train_batch_size: int = 32
     test_batch_size: int = 32
 
+    bucket_size: int = 0
+
     batch_split: int = 1
     n_jobs: int = 4
+    pin_memory: bool = False
 
     warmup_coef: float = 0.01
     max_grad_norm: float = 1
@@ -80,6 +88,9 @@ class Trainer:
     apex_loss_scale: float = None
 
     train_weights: defaultdict = None
+    seed: Optional[int] = None
+
+    checkpoint_steps: int = 0
 
     drop_optimizer: bool = False
     debug: bool = False
@@ -97,12 +108,20 @@ class Trainer:
         self.model = self.model.to(self.device)
         self.loss = self.loss.to(self.device)
 
+        if self.seed is None:
+            self.seed = self._draw_seed()
+
+        train_batch_size = int(self.train_batch_size // self.batch_split)
+        train_sampler = self._init_train_sampler()
         self.train_dataloader = Trainer._init_dataloader(self.train_dataset,
                                                          'Train',
-                                                         batch_size=int(self.train_batch_size // self.batch_split),
+                                                         batch_size=train_batch_size,
                                                          n_jobs=self.n_jobs,
-                                                         sampler=self._init_train_sampler(),
+                                                         sampler=train_sampler,
+                                                         batch_sampler=self._init_train_batch_sampler(
+                                                             train_sampler, train_batch_size),
                                                          drop_last=True,
+                                                         pin_memory=self.pin_memory,
                                                          collate_fun=self.collate_fun)
 
         self.test_dataloader = Trainer._init_dataloader(self.test_dataset,
@@ -111,12 +130,13 @@ class Trainer:
                                                         n_jobs=self.n_jobs,
                                                         sampler=None,
                                                         drop_last=False,
+                                                        pin_memory=self.pin_memory,
                                                         collate_fun=self.collate_fun)
 
         self.scheduler = None
         use_scheduler = self.train_dataloader is not None and self.optimizer is not None and self.warmup_coef > 0
         if use_scheduler:
-            num_training_steps = self.n_epochs * len(self.train_dataloader) // self.batch_split
+            num_training_steps = self.n_epochs * self._get_train_len(train_batch_size) // self.batch_split
             num_warmup_steps = int(num_training_steps * self.warmup_coef)
 
             logger.info(f'Wurmup scheldure is used. #Training steps: {num_training_steps}. '
@@ -144,39 +164,114 @@ class Trainer:
         self.global_step = 0
         self.writer = Trainer._init_writer(self.local_rank, self.writer_dir)
 
+        # position of training: current epoch and number of its consumed batches
+        self.epoch_i = 1
+        self.epoch_batches = 0
+
+        self._set_seed(self.seed)
+
         if self.debug:
             self.n_epochs = 2
 
+    def _draw_seed(self):
+        seed = torch.tensor([random.randrange(2 ** 31)], dtype=torch.int64, device=self.device)
+        if self.local_rank != -1:
+            # all processes draw the same samples, so seed of the first process is used
+            torch.distributed.broadcast(seed, 0)
+
+        logger.info(f'Seed of samplers was not set, so random seed {seed.item()} was drawn.')
+
+        return seed.item()
+
+    def _set_seed(self, seed):
+        # samples of epochs are drawn from seed by samplers and streaming dataset
+        self.seed = seed
+
+        samplers = [self.train_dataset, getattr(self.train_dataloader, 'batch_sampler', None)]
+        while samplers:
+            sampler = samplers.pop()
+            if hasattr(sampler, 'seed'):
+                sampler.seed = seed
+            samplers.extend(getattr(sampler, name) for name in ('batch_sampler', 'sampler') if hasattr(sampler, name))
+
+    def _get_train_len(self, batch_size):
+        # dataloader of iterable dataset has no length in torch 1.3
+        if isinstance(self.train_dataset, IterableDataset):
+            return len(self.train_dataset) // batch_size
+
+        return len(self.train_dataloader)
+
     def _init_train_sampler(self):
         if self.train_dataset is None:
             return None
 
-        if self.local_rank == -1:
-            if self.train_weights is None or self.train_weights['sampler_weights'] is None:
-                train_sampler = RandomSampler(self.train_dataset)
-            else:
-                assert len(self.train_weights['sampler_weights']) == len(self.train_dataset)
-                train_sampler = WeightedRandomSampler(self.train_weights['sampler_weights'],
-                                                      len(self.train_dataset))
+        if isinstance(self.train_dataset, IterableDataset):
+            # streaming dataset shuffles and splits samples between processes itself
+            if self.bucket_size > 0:
+                logger.warning('Samples of streaming dataset are not grouped by length.')
+            return None
+
+        # samples of epoch are drawn from seed and epoch, so they are reproduced after resuming
+        replicas = {'num_replicas': 1, 'rank': 0} if self.local_rank == -1 else {}
+
+        if self.train_weights is None or self.train_weights['sampler_weights'] is None:
+            train_sampler = DistributedRandomSampler(self.train_dataset, seed=self.seed, **replicas)
         else:
-            train_sampler = DistributedSampler(self.train_dataset)
+            assert len(self.train_weights['sampler_weights']) == len(self.train_dataset)
+            num_samples = self.train_weights['sampler_num_samples'] or len(self.train_dataset)
+
+            train_sampler = DistributedWeightedSampler(self.train_weights['sampler_weights'], num_samples,
+                                                       seed=self.seed, **replicas)
 
         logger.info(f'Used train sampler: {type(train_sampler).__name__}.')
 
         return train_sampler
 
+    def _init_bucket_batch_sampler(self, train_sampler, batch_size):
+        lengths = self.train_dataset.get_lengths() if hasattr(self.train_dataset, 'get_lengths') else None
+        if lengths is None:
+            logger.warning('Lengths of samples are unknown, so samples are not grouped by length. '
+                           'Use tokenized cache or chunk index to enable bucketing.')
+            return None
+
+        assert len(lengths) == len(self.train_dataset)
+
+        logger.info(f'Train samples are grouped by length in buckets of {self.bucket_size} batches.')
+
+        return BucketBatchSampler(train_sampler, lengths, batch_size, drop_last=True, bucket_size=self.bucket_size,
+                                  seed=self.seed)
+
+    def _init_train_batch_sampler(self, train_sampler, batch_size):
+        if train_sampler is None:
+            return None
+
+        batch_sampler = self._init_bucket_batch_sampler(train_sampler, batch_size) if self.bucket_size > 0 else None
+        if batch_sampler is None:
+            batch_sampler = BatchSampler(train_sampler, batch_size, drop_last=True)
+
+        return ResumableBatchSampler(batch_sampler)
+
     @staticmethod
-    def _init_dataloader(dataset, name, *, batch_size=1, n_jobs=0, sampler=None, drop_last=False, collate_fun=None):
+    def _init_dataloader(dataset, name, *, batch_size=1, n_jobs=0, sampler=None, batch_sampler=None, drop_last=False,
+                         pin_memory=False, collate_fun=None):
         if dataset is None:
             return None
 
         logger.info(f'{name} dataset len: {len(dataset)}. #JOBS: {n_jobs}.')
 
+        if batch_sampler is not None:
+            return torch.utils.data.DataLoader(dataset,
+                                               batch_sampler=batch_sampler,
+                                               num_workers=n_jobs,
+                                               pin_memory=pin_memory,
+                                               collate_fn=collate_fun)
+
         return torch.utils.data.DataLoader(dataset,
                                            batch_size=batch_size,
                                            num_workers=n_jobs,
                                            sampler=sampler,
                                            drop_last=drop_last,
+                                           pin_memory=pin_memory,
                                            shuffle=False,
                                            collate_fn=collate_fun)
 
@@ -240,7 +335,7 @@ class Trainer:
         if isinstance(data, (list, tuple)):
             return [self._to_device(d) for d in data]
         elif isinstance(data, torch.Tensor):
-            return data.to(self.device)
+            return data.to(self.device, non_blocking=self.pin_memory)
         elif isinstance(data, dict):
             return {k: self._to_device(v) for k, v in data.items()}
         elif data is None:
@@ -248,31 +343,55 @@ class Trainer:
         else:
             raise NotImplemented
 
-    def train(self, after_epoch_funcs=None):
+    def train(self, after_epoch_funcs=None, checkpoint_funcs=None):
         if self.train_dataloader is None:
             logger.warning('You have not specified train dataset, so you cannot run train method.')
             return
 
         after_epoch_funcs = [] if after_epoch_funcs is None else after_epoch_funcs
+        checkpoint_funcs = [] if checkpoint_funcs is None else checkpoint_funcs
 
         def run_after_funcs():
             for func in after_epoch_funcs:
                 func(epoch_i)
 
-        for epoch_i in range(1, self.n_epochs+1):
-            self._train(epoch_i)
+        def run_checkpoint_funcs():
+            for func in checkpoint_funcs:
+                func()
+
+        # training is started from restored position
+        for epoch_i in range(self.epoch_i, self.n_epochs+1):
+            self._train(epoch_i, checkpoint_fun=run_checkpoint_funcs)
             run_after_funcs()
 
+    def _set_epoch(self, epoch_i):
+        # distributed samplers draw new permutation or sample in every epoch
+        for sampler in (self.train_dataloader.sampler, self.train_dataloader.batch_sampler, self.train_dataset):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch_i)
+
     @time_profiler
-    def _train(self, epoch_i):
+    def _train(self, epoch_i, *, checkpoint_fun=None):
+        self._set_epoch(epoch_i)
         self.set_train()
         self.optimizer.zero_grad()
 
         avg_meters = defaultdict(AverageMeter)
 
-        tqdm_data = tqdm(self.train_dataloader, desc=f'Train (epoch #{epoch_i} / {self.n_epochs})')
+        # batches which were consumed before checkpoint are skipped
+        self.epoch_i = epoch_i
+        train_batches = self.train_dataloader
+        if isinstance(self.train_dataset, IterableDataset):
+            # order of streamed documents is drawn from seed and epoch, so consumed batches are read again and skipped
+            train_batches = itertools.islice(train_batches, self.epoch_batches, None)
+        else:
+            self.train_dataloader.batch_sampler.skip_batches = self.epoch_batches
+        if self.epoch_batches:
+            logger.info(f'Training is resumed from batch {self.epoch_batches} of epoch {epoch_i}.')
 
-        for i, (inputs, labels) in enumerate(tqdm_data):
+        tqdm_data = tqdm(train_batches, desc=f'Train (epoch #{epoch_i} / {self.n_epochs})')
+
+        for i, (inputs, labels) in enumerate(tqdm_data, start=self.epoch_batches):
             inputs, labels = self._to_device((inputs, labels))
 
             pred_logits = self.model(**inputs)
@@ -292,6 +411,11 @@ class Trainer:
                 self._update_writer(avg_meters, prefix='train')
 
                 self.global_step += 1
+                self.epoch_batches = i + 1
+
+                if checkpoint_fun is not None and self.checkpoint_steps > 0 and \
+                        self.global_step % self.checkpoint_steps == 0:
+                    checkpoint_fun()
 
                 if self.debug:
                     logger.info('Training was interrupted because of debug mode.')
@@ -299,6 +423,9 @@ class Trainer:
 
             Trainer._update_console(tqdm_data, avg_meters)
 
+        self.epoch_i = epoch_i + 1
+        self.epoch_batches = 0
+
     def test(self, epoch_i, *, callbacks=None):
         if self.local_rank in [0, -1]:
             if self.test_dataloader is None:
@@ -352,14 +479,41 @@ class Trainer:
         metrics = {k: v() if isinstance(v, AverageMeter) else v for k, v in avg_meters.items()}
         logger.info(f'Test metrics after epoch {epoch_i} - {Trainer._get_console_str(metrics)}')
 
-    def save_state_dict(self, path_):
-        if self.local_rank not in [-1, 0]:
-            return
+    @staticmethod
+    def _get_rng_state():
+        # numpy state is stored as python objects, so checkpoint does not contain numpy arrays
+        name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+
+        return {'python': random.getstate(),
+                'numpy': (name, keys.tolist(), position, has_gauss, cached_gaussian),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+    @staticmethod
+    def _set_rng_state(rng_state):
+        random.setstate(rng_state['python'])
+        name, keys, position, has_gauss, cached_gaussian = rng_state['numpy']
+        np.random.set_state((name, np.asarray(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+        torch.set_rng_state(rng_state['torch'].cpu())
 
+        if rng_state['cuda'] is not None and torch.cuda.is_available() and \
+                len(rng_state['cuda']) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all([state.cpu() for state in rng_state['cuda']])
+
+    @staticmethod
+    def _get_rank_path(path_, rank):
+        return f'{path_}.rank_{rank}'
+
+    def save_state_dict(self, path_):
         if self.debug:
             logger.info(f'Model was not saved to {path_} because of debug mode.')
             return
 
+        if self.local_rank not in [-1, 0]:
+            # every process restores its own random state
+            torch.save({'rng_state': Trainer._get_rng_state()}, Trainer._get_rank_path(path_, self.local_rank))
+            return
+
         model = self.model.module if isinstance(self.model, nn.parallel.DistributedDataParallel) else self.model
 
         model_dict = model.state_dict()
@@ -369,7 +523,11 @@ class Trainer:
         state_dict = {'model': model_dict,
                       'optimizer': optimizer_dict,
                       'scheduler': scheduler_dict,
-                      'global_step': self.global_step}
+                      'global_step': self.global_step,
+                      'epoch_i': self.epoch_i,
+                      'epoch_batches': self.epoch_batches,
+                      'seed': self.seed,
+                      'rng_state': Trainer._get_rng_state()}
 
         if apex is not None:
             state_dict['apex'] = apex.amp.state_dict()
@@ -401,3 +559,24 @@ class Trainer:
                 apex.amp.load_state_dict(state_dict['amp'])
 
             logger.info(f'Optimizer and scheduler also were restored from {path_} checkpoint.')
+
+            if 'epoch_i' in state_dict:
+                self._load_position(path_, state_dict)
+
+    def _load_position(self, path_, state_dict):
+        self.epoch_i = state_dict['epoch_i']
+        self.epoch_batches = state_dict['epoch_batches']
+
+        # consumed batches are skipped only if samples of epoch are drawn again from the same seed
+        if 'seed' in state_dict:
+            self._set_seed(state_dict['seed'])
+
+        rank_path = Trainer._get_rank_path(path_, self.local_rank)
+        if self.local_rank not in [-1, 0] and os.path.exists(rank_path):
+            Trainer._set_rng_state(torch.load(rank_path)['rng_state'])
+        elif self.local_rank in [-1, 0]:
+            Trainer._set_rng_state(state_dict['rng_state'])
+        else:
+            logger.warning(f'Random state of process {self.local_rank} was not found in {rank_path}.')
+
+        logger.info(f'Training will be resumed from batch {self.epoch_batches} of epoch {self.epoch_i}.')
@@ -1,61 +1,131 @@
+import functools
 import logging
 import multiprocessing as mp
+import os
+import queue
+import traceback
 
 import numpy as np
 
 logger = logging.getLogger(__file__)
 
+# state of pool workers, it is set once by pool initializer
+_worker_state = {}
+
 
 class ListDalatoaderIterator:
     def __init__(self, processor):
-        self.manager = mp.Manager()
-        self.pool_queue = self.manager.Queue(processor.buffer_size)
-        self.pool = mp.Pool(processor.n_jobs)
+        # plain queue is inherited by pool workers, it is not proxied by manager process. Messages contain at most
+        # batch_size chunks, so queue keeps about buffer_size chunks and number of shared memory handles in flight
+        # is bounded as well
+        queue_size = max(processor.buffer_size // processor.batch_size, 2 * processor.n_jobs)
+        self.pool_queue = mp.Queue(queue_size)
+
+        # dataset is shipped to every worker once instead of being pickled with every job. Only batches of workers
+        # are collated into shared memory, the rest of chunks is collated by collate_fun in the main process
+        worker_collate_fun = functools.partial(processor.collate_fun, share_memory=True) \
+            if processor.collate_in_workers else None
+        self.pool = mp.Pool(processor.n_jobs, initializer=ListDalatoaderIterator._init_worker,
+                            initargs=(processor.dataset, self.pool_queue, worker_collate_fun, processor.batch_size))
+        # killed worker is replaced by pool, but its job is lost, so initial workers are watched
+        self.workers = list(self.pool._pool)
+        self.job_errors = []
+        self.owner_pid = os.getpid()
 
         self.processor = processor
 
-        self.jobs = []
+    @staticmethod
+    def _init_worker(dataset, pool_queue, collate_fun, batch_size):
+        _worker_state['dataset'] = dataset
+        _worker_state['queue'] = pool_queue
+        _worker_state['collate_fun'] = collate_fun
+        _worker_state['batch_size'] = batch_size
 
-        self.num_done_jobs = 0
+    @staticmethod
+    def _worker_fun(idxs):
+        # messages are pairs of chunks and collated batch, end of job is marked by sentinel
+        dataset, pool_queue = _worker_state['dataset'], _worker_state['queue']
+        collate_fun, batch_size = _worker_state['collate_fun'], _worker_state['batch_size']
+        try:
+            chunks = []
+            for idx in idxs:
+                chunks.extend(dataset[idx])
 
-    def _job_done_callback(self, *args, **kwargs):
-        self.num_done_jobs += 1
+                # chunks are sent by batches, tensors of collated batch are sent as handles of shared memory
+                while len(chunks) >= batch_size:
+                    batch, chunks = chunks[:batch_size], chunks[batch_size:]
+                    pool_queue.put((None, collate_fun(batch)) if collate_fun is not None else (batch, None))
 
-    def _job_error_callback(self, error):
-        logger.error(error)
-        self.pool.terminate()
-        raise error
+            # the rest of chunks of job is collated in the main process
+            if chunks:
+                pool_queue.put((chunks, None))
+        except Exception:
+            # errors are raised in the main process, traceback is sent as text because exception can be unpicklable
+            pool_queue.put(RuntimeError(f'Error in ListDataloader worker:\n{traceback.format_exc()}'))
 
-    @staticmethod
-    def _worker_fun(dataset, idx, pool_queue):
-        chunks = dataset[idx]
-        for chunk in chunks:
-            pool_queue.put(chunk)
+        pool_queue.put(None)
 
     def __iter__(self):
         return self._generator()
 
+    def _submit_job(self, jobs):
+        idxs = next(jobs, None)
+        if idxs is None:
+            return False
+
+        self.pool.apply_async(ListDalatoaderIterator._worker_fun, (idxs,), error_callback=self.job_errors.append)
+
+        return True
+
+    def _get_message(self, timeout=1):
+        while True:
+            try:
+                return self.pool_queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+
+            # sentinel of job is not sent if job failed outside of worker function or worker was killed
+            if self.job_errors:
+                raise self.job_errors[0]
+
+            dead_workers = [worker.pid for worker in self.workers if worker.exitcode is not None]
+            if dead_workers:
+                raise RuntimeError(f'ListDataloader workers {dead_workers} exited unexpectedly.')
+
     def _generator(self):
         try:
             idxs = np.arange(0, len(self.processor.dataset))
             if self.processor.shuffle:
                 np.random.shuffle(idxs)
 
-            for idx in idxs:
-                self.jobs.append(self.pool.apply_async(ListDalatoaderIterator._worker_fun,
-                                                       (self.processor.dataset, idx, self.pool_queue),
-                                                       callback=self._job_done_callback,
-                                                       error_callback=self._job_error_callback))
-            batch = []
-            while True:
-                chunk = self.pool_queue.get()
-                batch.append(chunk)
-                if len(batch) == self.processor.batch_size:
-                    yield self.processor.process_batch(batch)
-                    batch = []
+            # every job fills at least one batch if batches are collated in workers
+            job_size = max(self.processor.job_size, self.processor.batch_size) if self.processor.collate_in_workers \
+                else self.processor.job_size
+            jobs = (idxs[start:start + job_size] for start in range(0, len(idxs), job_size))
 
-                if self.pool_queue.empty() and self.num_done_jobs == len(idxs):
-                    break
+            # number of submitted and not finished jobs is bounded by window
+            n_running_jobs = sum(self._submit_job(jobs) for _ in range(2 * self.processor.n_jobs))
+
+            batch = []
+            while n_running_jobs:
+                message = self._get_message()
+                if message is None:
+                    n_running_jobs += self._submit_job(jobs) - 1
+                    continue
+
+                if isinstance(message, Exception):
+                    raise message
+
+                chunks, collated_batch = message
+                if collated_batch is not None:
+                    yield collated_batch
+                    continue
+
+                for chunk in chunks:
+                    batch.append(chunk)
+                    if len(batch) == self.processor.batch_size:
+                        yield self.processor.process_batch(batch)
+                        batch = []
 
             if len(batch):
                 yield self.processor.process_batch(batch)
@@ -65,13 +135,14 @@ class ListDalatoaderIterator:
             raise e
 
     def _close_jobs(self):
-        self.pool.close()
+        # workers can be blocked by full queue if iteration was stopped early
+        self.pool.terminate()
         self.pool.join()
 
-        self.manager.shutdown()
-
     def __del__(self):
-        self._close_jobs()
+        # iterator can be collected in forked process which does not own the pool
+        if os.getpid() == self.owner_pid:
+            self._close_jobs()
 
 
 class ListDataloader:
@@ -79,6 +150,8 @@ class ListDataloader:
                  n_jobs=4,
                  collate_fun=None,
                  buffer_size=1024,
+                 job_size=64,
+                 collate_in_workers=False,
                  shuffle=False):
         self.dataset = dataset
         self.batch_size = batch_size
@@ -87,7 +160,9 @@ class ListDataloader:
         self.n_jobs = n_jobs
 
         self.buffer_size = buffer_size
+        self.job_size = job_size
 
+        self.collate_in_workers = collate_in_workers and collate_fun is not None
         self.shuffle = shuffle
 
     def process_batch(self, batch):
@@ -85,7 +85,9 @@ def get_model_parser() -> configargparse.ArgumentParser:
 def init_base_arguments(parser):
     parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
 
-    parser.add_argument('--data_path', type=str, required=True, help='Path to JSON with documents.')
+    parser.add_argument('--data_path', type=str, required=True,
+                        help='Path to JSON with documents. Glob pattern or gzip/zstd compressed files '
+                             'are read as a stream.')
     parser.add_argument('--processed_data_path', type=str, required=True,
                         help='Path where processed dataset will be saved.')
 
@@ -97,8 +99,27 @@ def init_base_arguments(parser):
 
     parser.add_argument('--split_by_sentence', action='store_true', help='Split document by sentence instead.')
     parser.add_argument('--truncate', action='store_true', help='Cut off long sentences during splitting by sentence.')
+    parser.add_argument('--cache_tokens', action='store_true',
+                        help='Tokenize documents once and read them from tokenized cache.')
+    parser.add_argument('--chunk_index', action='store_true',
+                        help='Sample train chunks from precomputed index of document windows, '
+                             'requires tokenized cache.')
+    parser.add_argument('--shared_arrays_dir', type=str, default=None,
+                        help='Node-local directory of index arrays which are shared by dataloader workers. '
+                             '/dev/shm is used if arrays fit into it, temporary directory otherwise.')
+
+    parser.add_argument('--tokenizer_cache_size', type=int, default=0,
+                        help='Number of cached word encodings in tokenizer, cache is prewarmed with the most frequent '
+                             'words of processed data. Set 0 to disable cache.')
 
     parser.add_argument('--n_jobs', type=int, default=16, help='Number of threads used in dataloader.')
+    parser.add_argument('--preprocess_n_jobs', type=int, default=1,
+                        help='Number of processes used to preprocess raw data.')
+    parser.add_argument('--storage_codec', type=str, default='json', choices=['json', 'orjson', 'msgpack'],
+                        help='Codec of processed documents.')
+    parser.add_argument('--split_strategy', type=str, default='random', choices=['random', 'hash'],
+                        help='Train/test split strategy: random split of every label or '
+                             'stable split by hash of example id which is kept when new data is added.')
 
 
 def get_trainer_parser() -> configargparse.ArgumentParser:
@@ -112,6 +133,9 @@ def get_trainer_parser() -> configargparse.ArgumentParser:
     parser.add_argument('--experiment_name', type=str, required=True, help='Experiment name.')
 
     parser.add_argument('--last', type=cast2(str), default=None, help='Restored checkpoint.')
+    parser.add_argument('--checkpoint_steps', type=int, default=0,
+                        help='Save last checkpoint every this number of training steps, training is resumed from '
+                             'the next batch of epoch. Set 0 to save checkpoints after epochs only.')
 
     parser.add_argument('--seed', type=cast2(int), default=None, help='Seed for random state.')
 
@@ -121,6 +145,23 @@ def get_trainer_parser() -> configargparse.ArgumentParser:
     parser.add_argument('--test_batch_size', type=int, default=16, help='Number of items in batch.')
     parser.add_argument('--batch_split', type=int, default=1,
                         help='Batch will be split into this number of chunks during training.')
+    parser.add_argument('--bucket_size', type=int, default=0,
+                        help='Number of train batches in bucket of samples which are grouped by length. '
+                             'Set 0 to disable bucketing.')
+    parser.add_argument('--pack_sequences', action='store_true',
+                        help='Pack several items into one row of max_seq_len tokens, '
+                             'increase batch size to fill the rows.')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read train documents sequentially by blocks and shuffle them through buffer '
+                             'instead of random access to documents.')
+    parser.add_argument('--stream_block_size', type=int, default=1024,
+                        help='Number of documents which are read sequentially during streaming.')
+    parser.add_argument('--shuffle_buffer_size', type=int, default=10000,
+                        help='Number of items in shuffle buffer of every dataloader worker during streaming.')
+    parser.add_argument('--pin_memory', action='store_true',
+                        help='Collate batches into pinned memory to speed up copying to gpu.')
+    parser.add_argument('--pad_multiple', type=int, default=1,
+                        help='Pad batch length to multiple of this number, use 8 for tensor cores.')
 
     parser.add_argument('--lr', type=float, default=1e-5, help='Learning rate for optimizer.')
     parser.add_argument('--weight_decay', type=float, default=0.01, help='Weight decay for optimizer.')
@@ -201,6 +242,8 @@ def get_predictor_parser() -> configargparse.ArgumentParser:
 
     parser.add_argument('--batch_size', type=int, default=16, help='Batch size.')
     parser.add_argument('--buffer_size', type=int, default=4096, help='Buffer queue size.')
+    parser.add_argument('--collate_in_workers', action='store_true',
+                        help='Collate batches in worker processes into shared memory tensors.')
 
     parser.add_argument('--limit', type=cast2(int), default=None, help='Process only specified number of documents.')
 
@@ -43,7 +43,8 @@ def run_worker(device, params, model_params):
         logger.warning(f'Batch size will be increased by {params.dist_world_size} times because of distributed '
                        f'training. Correct your learning rate in the proper way.')
 
-    model, tokenizer = init_model(model_params, bpe_dropout=params.bpe_dropout)
+    model, tokenizer = init_model(model_params, bpe_dropout=params.bpe_dropout,
+                                  tokenizer_cache_size=params.tokenizer_cache_size)
     optimizer = init_optimizer(params, model)
 
     if params.local_rank in [0, -1]:
@@ -60,9 +61,15 @@ def run_worker(device, params, model_params):
 
     loss = init_loss(params, train_weights)
 
+    # batches are collated into pinned memory in the main process, dataloader pins batches of worker processes
+    pin_memory = params.pin_memory and device.type == 'cuda'
+
     trainer = Trainer(model=model,
                       loss=loss,
-                      collate_fun=init_collate_fun(tokenizer),
+                      collate_fun=init_collate_fun(tokenizer, pack_sequences=params.pack_sequences,
+                                                   max_seq_len=params.max_seq_len,
+                                                   pin_memory=pin_memory and params.n_jobs == 0,
+                                                   pad_multiple=params.pad_multiple),
 
                       optimizer=optimizer,
 
@@ -82,8 +89,11 @@ def run_worker(device, params, model_params):
                       train_batch_size=params.train_batch_size,
                       test_batch_size=params.test_batch_size,
 
+                      bucket_size=params.bucket_size,
+
                       batch_split=params.batch_split,
                       n_jobs=params.n_jobs,
+                      pin_memory=pin_memory,
 
                       warmup_coef=params.warmup_coef,
                       max_grad_norm=params.max_grad_norm,
@@ -93,6 +103,8 @@ def run_worker(device, params, model_params):
                       apex_loss_scale=params.apex_loss_scale,
 
                       train_weights=train_weights,
+                      seed=params.seed,
+                      checkpoint_steps=params.checkpoint_steps,
 
                       drop_optimizer=params.drop_optimizer,
                       debug=params.debug
@@ -113,7 +125,7 @@ def run_worker(device, params, model_params):
                                                           SaveBestCallback(params)])
 
     try:
-        trainer.train(after_epoch_funcs=[save_last, save_each, test_fun])
+        trainer.train(after_epoch_funcs=[save_last, save_each, test_fun], checkpoint_funcs=[save_last])
     except KeyboardInterrupt:
         logger.error('Training process was interrupted.')
         trainer.save_state_dict(params.dump_dir / params.experiment_name / 'interrupt.ch')
@@ -3,25 +3,31 @@ import multiprocessing as mp
 import torch
 
 from utils import get_logger, set_seed, show_params
-from init import init_collate_fun, init_model
+from init import init_collate_fun, init_model, init_tokenized_cache, init_tokenizer_cache
 
 from model.utils.parser import get_model_parser, get_predictor_parser, get_params
 from model.inference.predictor import Predictor
 from model.dataset import RawPreprocessor, ChunkDataset
 
-from transformers import BertTokenizer
-
 
 def get_validation_dataset(params, *, tokenizer=None, clear=False):
     preprocessor = RawPreprocessor(raw_json=params.data_path,
                                    out_dir=params.processed_data_path,
-                                   clear=clear)
+                                   clear=clear,
+                                   n_jobs=params.preprocess_n_jobs,
+                                   codec=params.storage_codec,
+                                   split_strategy=params.split_strategy,
+                                   count_words=params.tokenizer_cache_size > 0)
     _, _, (_, _, val_indexes, val_labels) = preprocessor()
 
+    init_tokenizer_cache(params, tokenizer)
+    cache = init_tokenized_cache(params, tokenizer, split_by_sentence=True)
+
     val_dataset = ChunkDataset(params.processed_data_path, tokenizer, val_indexes,
                                test=False,
                                split_by_sentence=True,
-                               truncate=True)
+                               truncate=True,
+                               cache=cache)
 
     return val_dataset
 
@@ -32,11 +38,8 @@ def main(params, model_params):
 
     device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
 
-    model, tokenizer = init_model(model_params, checkpoint=params.checkpoint, device=device)
-
-    # todo: Tokenizer from tokenizers does not work with my implementation of dataloader
-    tokenizer = BertTokenizer.from_pretrained(model_params.model)
-    tokenizer.model_name = 'bert'
+    model, tokenizer = init_model(model_params, checkpoint=params.checkpoint, device=device,
+                                  tokenizer_cache_size=params.tokenizer_cache_size)
 
     val_dataset = get_validation_dataset(params, tokenizer=tokenizer, clear=False)
 
@@ -46,6 +49,7 @@ def main(params, model_params):
                           batch_size=params.batch_size,
                           n_jobs=params.n_jobs,
                           buffer_size=params.buffer_size,
+                          collate_in_workers=params.collate_in_workers,
                           limit=params.limit)
 
     predictor(val_dataset)